@@ -1,21 +1,22 @@
-from fastapi import FastAPI
-import uvicorn
+from fastapi import FastAPI, HTTPException, Query
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
+from typing import Any, Dict, List, Literal
+import numpy as np
 import pandas as pd
 import util as util
 import data_pipeline as data_pipeline
-import preprocessing as preprocessing 
-
-import shap
+import inference as inference
+import registry as registry
+import serving as serving
 
 config_data = util.load_config()
 
-ohe_Department = config_data["ohe_Department_path"]
-ohe_JobRole = config_data["ohe_JobRole_path"]
-ohe_OverTime = config_data["ohe_OverTime_path"]
+# Schema checks compiled once from config
+validator = data_pipeline.SchemaValidator(config_data)
 
-le_encoder = util.pickle_load(config_data["le_encoder_path"])
-model_data = util.pickle_load(config_data["production_model_path"])
+# Bounded pool for CPU bound inference and explanation
+inference_pool = serving.InferencePool(config_data["api_workers"], config_data["api_queue_depth"], config_data["api_async"])
 
 class api_data(BaseModel):
     JobLevel : int
@@ -32,58 +33,208 @@ class api_data(BaseModel):
     JobRole : str
     OverTime : str
 
-app = FastAPI()
+class api_model_data(BaseModel):
+    model_uid : str
+
+class api_batch_data(BaseModel):
+    # Either list of records or columnar payload (column name -> list of values)
+    records : List[Dict[str, Any]] = []
+    columns : Dict[str, List[Any]] = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load encoders, model and explainer once before serving, prefork parent has done it already
+    if inference.context is None:
+        inference.load_context(config_data)
+
+    # Watch for new production model in background
+    watcher = inference.ModelWatcher(config_data)
+    watcher.start()
+    yield
+    watcher.stop()
+    inference_pool.shutdown()
+
+app = FastAPI(lifespan = lifespan)
+
+async def run_inference(func, *args):
+    # Reject instead of queueing without bound
+    try:
+        return await inference_pool.run(func, *args)
+    except serving.PoolFullError as pe:
+        raise HTTPException(status_code = 429, detail = str(pe))
 
 @app.get("/")
 def home():
     return "Employer-Turnover-Predictor API is up!"
 
 @app.post("/predict/")
-def predict(data: api_data):
-    print(data)
-    data = pd.DataFrame(data).set_index(0).T.reset_index(drop = True)
-    print(data)
-    data_columns = data.columns.to_list()
-
-    # data type
-    data = pd.concat(
-        [
-            data[list(set(config_data["predictor_columns"]) & set(config_data["object_columns"]))].astype(object),
-            data[list(set(config_data["predictor_columns"]) & set(config_data["int64_columns"]))].astype(int)
-        ],
-        axis = 1
-    )
-    data = data[data_columns]
+async def predict(data: api_data, explain: Literal["none", "top_k", "approximate", "exact"] = "exact", k: int = Query(3, ge = 1)):
+    # Same record, explanation and model give same response
+    if config_data["cache_enabled"]:
+        model_uid = inference.get_context(config_data).model_uid
+        cache_key = prediction_cache.make_key(data.model_dump(), explain, k if explain == "top_k" else None)
+        res = prediction_cache.get(cache_key, model_uid)
+        if res is not None:
+            return res
+
+    # Concurrent requests are scored together, response stays per record
+    if config_data["api_batching"]:
+        try:
+            res = await prediction_batcher.submit((data, explain, k))
+        except serving.PoolFullError as pe:
+            raise HTTPException(status_code = 429, detail = str(pe))
+    else:
+        res = (await run_inference(predict_record_batch, [(data, explain, k)]))[0]
+
+    if config_data["cache_enabled"] and res["error_msg"] == "":
+        prediction_cache.put(cache_key, model_uid, res)
+
+    return res
+
+@app.post("/predict/batch")
+async def predict_batch(data: api_batch_data):
+    return await run_inference(predict_records, data)
+
+def predict_record_batch(requests: list) -> list:
+    # Every request is (record, explain mode, k)
+    records = [record.model_dump() for record, _, _ in requests]
+    res = [None] * len(records)
 
     # check data
-    try:
-        data_pipeline.check_data(data, config_data, api=True)
-    except AssertionError as ae:
-        return {"res": [], "error_msg": str(ae)}
-    
+    error_msg = validator.error_messages(records)
+    for row in error_msg.index[error_msg != ""]:
+        res[row] = {"res": [], "error_msg": error_msg[row]}
+
+    valid_rows = error_msg.index[error_msg == ""]
+    if len(valid_rows) == 0:
+        return res
+
+    context = inference.get_context(config_data)
+
     # encoding
-    data = preprocessing.ohe_transform(data, "Department", ohe_Department)
-    data = preprocessing.ohe_transform(data, "JobRole", ohe_JobRole)
-    data = preprocessing.ohe_transform(data, "OverTime", ohe_OverTime)
-
-    # predict
-    prediction = model_data["model_data"]["model_object"].predict_proba(data)[:, 1][0]
-    # result = f'The probability of employee turnover is: {prediction:.0%}'
-
-    explainer = shap.Explainer(model_data["model_data"]["model_object"])
-    shap_base_values = explainer(data).base_values
-    shap_values = explainer(data).values
-    shap_features = explainer(data).data
-    shap_feature_name = data.columns
-
-    print()
-
-    return {"res" : prediction, 
-            "shap_values" : shap_values.tolist(), 
-            "shap_base_values" : shap_base_values.tolist(), 
-            "shap_feature" : shap_features.tolist(), 
-            "shap_feature_name" : shap_feature_name.tolist(), 
+    data = context.encode([records[row] for row in valid_rows])
+
+    # predict the whole batch at once
+    prediction = context.predict_proba(data)
+
+    # explain at most once per explanation kind, only rows that asked for it
+    explain_mode = [requests[row][1] for row in valid_rows]
+    explanation = dict()
+    for approximate, modes in [(False, ["exact", "top_k"]), (True, ["approximate"])]:
+        rows = [i for i, mode in enumerate(explain_mode) if mode in modes]
+        if len(rows) > 0:
+            explanation[approximate] = (rows, context.explain(data.iloc[rows], approximate))
+
+    # Split result back per record
+    for i, row in enumerate(valid_rows):
+        res[row] = {"res" : float(prediction[i]),
+                    "shap_values" : [],
+                    "shap_base_values" : [],
+                    "shap_feature" : [],
+                    "shap_feature_name" : [],
+                    "error_msg" : ""}
+
+        if explain_mode[i] != "none":
+            rows, batch_explanation = explanation[explain_mode[i] == "approximate"]
+            res[row].update(explanation_payload(batch_explanation, rows.index(i), explain_mode[i] == "top_k", requests[row][2]))
+
+    return res
+
+def explanation_payload(explanation: dict, i: int, top_k: bool = False, k: int = 3) -> dict:
+    shap_values = explanation["shap_values"][i:i+1]
+    shap_feature = explanation["shap_feature"][i:i+1]
+    shap_feature_name = np.asarray(explanation["shap_feature_name"])
+
+    # Keep only k strongest contributors toward turnover (last class)
+    if top_k:
+        strength = np.abs(shap_values[0] if shap_values.ndim == 2 else shap_values[0, :, -1])
+        top = np.argsort(-strength, kind = "stable")[:k]
+        shap_values = shap_values[:, top]
+        shap_feature = shap_feature[:, top]
+        shap_feature_name = shap_feature_name[top]
+
+    return {"shap_values" : shap_values.tolist(),
+            "shap_base_values" : explanation["shap_base_values"][i:i+1].tolist(),
+            "shap_feature" : shap_feature.tolist(),
+            "shap_feature_name" : shap_feature_name.tolist()}
+
+# Responses of recently scored records
+prediction_cache = serving.PredictionCache(config_data["cache_max_entries"], config_data["cache_max_bytes"], config_data["cache_ttl_seconds"])
+
+# Coalesce concurrent /predict/ requests into one scoring call
+prediction_batcher = serving.PredictionBatcher(inference_pool, predict_record_batch, config_data["batch_max_size"], config_data["batch_max_wait_ms"])
+
+def predict_records(data: api_batch_data) -> dict:
+    # Build one frame from records or columnar payload
+    try:
+        if len(data.records) > 0:
+            data = pd.DataFrame(data.records)
+        else:
+            data = pd.DataFrame(data.columns)
+    except ValueError as ve:
+        return {"res": [], "error_msg": str(ve)}
+
+    data = data.reset_index(drop = True)
+    res = [None] * len(data)
+
+    # check data, invalid rows are reported without failing the batch
+    error_msg = validator.error_messages(data)
+    valid_rows = error_msg.index[error_msg == ""]
+
+    if len(valid_rows) > 0:
+        context = inference.get_context(config_data)
+
+        # encoding
+        data = context.encode(data.loc[valid_rows])
+
+        # predict
+        prediction = context.predict_proba(data)
+        for row, proba in zip(valid_rows, prediction):
+            res[row] = float(proba)
+
+    return {"res" : res,
+            "error_msg" : error_msg.to_list()}
+
+def model_info(context: inference.InferenceContext) -> dict:
+    return {"model_uid" : context.model_uid,
+            "model_name" : context.model_data["model_log"]["model_name"],
+            "pinned" : registry.pinned_version(config_data),
+            "versions" : registry.list_versions(config_data),
             "error_msg" : ""}
 
+@app.get("/admin/model")
+def admin_model():
+    return model_info(inference.get_context(config_data))
+
+@app.post("/admin/model/pin")
+def admin_model_pin(data: api_model_data):
+    # Pin or roll back to a registered version, swapped in once warmed
+    try:
+        registry.pin_version(data.model_uid, config_data)
+    except RuntimeError as re:
+        raise HTTPException(status_code = 404, detail = str(re))
+
+    return model_info(inference.load_context(config_data))
+
+@app.post("/admin/model/unpin")
+def admin_model_unpin():
+    # Follow production model again
+    registry.unpin_version(config_data)
+    return model_info(inference.load_context(config_data))
+
+@app.get("/admin/cache")
+def admin_cache():
+    return prediction_cache.stats()
+
+def preload_context() -> None:
+    # Everything a worker may need, loaded once and shared by forked workers
+    context = inference.load_context(config_data)
+    context.preload()
+
 if __name__ == "__main__":
-    uvicorn.run("api:app", host="0.0.0.0", port=8080)
\ No newline at end of file
+    if config_data["api_processes"] > 1 and config_data["api_prefork"]:
+        serving.serve_prefork(app, config_data["api_host"], config_data["api_port"], config_data["api_processes"], preload_context)
+    else:
+        # Independent processes, each loads its own inference context
+        import uvicorn
+        uvicorn.run("api:app", host=config_data["api_host"], port=config_data["api_port"], workers=config_data["api_processes"])
\ No newline at end of file
@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# Bump when layout of exported arrays changes
+format_version = 1
+
+def artifact_path(model_path: str) -> str:
+    # Artifact lives next to the pickle it was exported from
+    return f"{os.path.splitext(model_path)[0]}.npz"
+
+def file_digest(file_path: str) -> str:
+    # Content hash of model file, ties artifact to the exact pickle it was exported from
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def sklearn_trees(estimators: list) -> list:
+    # Node arrays of fitted sklearn trees, leaf value is probability of last class
+    trees = list()
+    for estimator in estimators:
+        tree = estimator.tree_
+        value = tree.value[:, 0, :]
+        normalizer = value.sum(axis = 1)
+        normalizer[normalizer == 0.0] = 1.0
+        trees.append({"left": tree.children_left, "right": tree.children_right, "feature": tree.feature,
+                      "threshold": tree.threshold, "value": value[:, -1] / normalizer,
+                      "default_left": np.ones(tree.node_count, dtype = bool)})
+    return trees
+
+def xgboost_trees(model) -> tuple:
+    # Node arrays from xgboost JSON model, leaf value is margin of the leaf
+    booster = json.loads(model.get_booster().save_raw("json"))["learner"]
+    if booster["objective"]["name"] != "binary:logistic":
+        raise ValueError("Only binary:logistic objective can be exported.")
+
+    trees = list()
+    for tree in booster["gradient_booster"]["model"]["trees"]:
+        left = np.asarray(tree["left_children"], dtype = np.int64)
+        trees.append({"left": left, "right": np.asarray(tree["right_children"], dtype = np.int64),
+                      "feature": np.asarray(tree["split_indices"], dtype = np.int64),
+                      "threshold": np.asarray(tree["split_conditions"], dtype = np.float32).astype(np.float64),
+                      "value": np.where(left == -1, np.asarray(tree["split_conditions"], dtype = np.float32), 0.0),
+                      "default_left": np.asarray(tree["default_left"], dtype = bool)})
+
+    # Trees after best iteration are not used by predict_proba
+    try:
+        trees = trees[:model.best_iteration + 1]
+    except AttributeError:
+        pass
+
+    base_score = float(booster["learner_model_param"]["base_score"].strip("[]"))
+    return trees, np.log(base_score / (1 - base_score))
+
+def export_artifact(model_object, model_uid: str, ohe_encoders: dict, int_columns: list, file_path: str,
+                    source_digest: str = None) -> bool:
+    """
+    Write model as plain arrays plus encoder layout. Returns False when model type
+    has no compact form, serving then keeps using the pickle. Digest of the pickle lets
+    serving trust the artifact without loading the pickle.
+    """
+    # Hyperparams tuned model keeps the fitted estimator in best_estimator_
+    model = getattr(model_object, "best_estimator_", model_object)
+    model_name = model.__class__.__name__
+
+    meta = {"format_version": format_version,
+            "model_uid": model_uid,
+            "model_name": model_name,
+            "feature_names": [str(name) for name in model.feature_names_in_],
+            "ohe_categories": {col: [str(category) for category in ohe.categories_[0]] for col, ohe in ohe_encoders.items()},
+            "int_columns": list(int_columns),
+            "source_digest": source_digest}
+    arrays = dict()
+
+    if model_name in ["RandomForestClassifier", "DecisionTreeClassifier"]:
+        trees = sklearn_trees(getattr(model, "estimators_", [model]))
+        meta.update({"kind": "trees", "decision": "le", "aggregation": "mean", "base_margin": 0.0})
+    elif model_name == "XGBClassifier":
+        trees, base_margin = xgboost_trees(model)
+        meta.update({"kind": "trees", "decision": "lt", "aggregation": "logistic", "base_margin": float(base_margin)})
+    elif model_name == "LogisticRegression":
+        meta.update({"kind": "linear"})
+        arrays.update({"coef": model.coef_[-1:], "intercept": model.intercept_[-1:]})
+    else:
+        return False
+
+    if meta["kind"] == "trees":
+        # All trees in one set of arrays, children point to global node position
+        sizes = [len(tree["left"]) for tree in trees]
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+        for key in ["left", "right"]:
+            arrays[key] = np.concatenate([np.where(tree[key] == -1, -1, tree[key] + offset) for tree, offset in zip(trees, offsets)])
+        for key in ["feature", "threshold", "value", "default_left"]:
+            arrays[key] = np.concatenate([tree[key] for tree in trees])
+        arrays["feature"] = np.where(arrays["left"] == -1, 0, arrays["feature"]).astype(np.int64)
+        arrays["root"] = offsets
+
+    # Written then renamed, so readers never see half written file
+    tmp_path = f"{file_path}.tmp.npz"
+    np.savez(tmp_path, meta = np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_path, file_path)
+    return True
+
+def sigmoid(z: np.ndarray) -> np.ndarray:
+    # Exp is rounded once to input precision, like C expf used by scipy and xgboost for float32
+    exp = np.exp(-z.astype(np.float64)).astype(z.dtype)
+    return (z.dtype.type(1) / (exp + z.dtype.type(1))).astype(np.float64)
+
+class CompactModel:
+    """
+    Pure NumPy predictor of an exported artifact. Encodes raw records with stored OHE
+    layout and returns probability of turnover, without sklearn or xgboost.
+    """
+    def __init__(self, file_path: str):
+        with np.load(file_path, allow_pickle = False) as artifact:
+            meta = json.loads(str(artifact["meta"]))
+            self.arrays = {key: artifact[key] for key in artifact.files if key != "meta"}
+
+        if meta["format_version"] != format_version:
+            raise ValueError("Artifact format {} is not supported.".format(meta["format_version"]))
+
+        self.meta = meta
+        self.model_uid = meta["model_uid"]
+        self.source_digest = meta.get("source_digest")
+        self.feature_names = meta["feature_names"]
+        self.kind = meta["kind"]
+        self.trees = TreeEnsemble(self.arrays, meta["decision"]) if self.kind == "trees" else None
+
+        # Position of every feature, one hot columns are addressed by (column, category)
+        position = {name: i for i, name in enumerate(self.feature_names)}
+        self.int_positions = [(col, position[col]) for col in meta["int_columns"]]
+        self.ohe_positions = {col: {category: position[f"{col}_{category}"] for category in categories}
+                              for col, categories in meta["ohe_categories"].items()}
+
+    def encode(self, data) -> np.ndarray:
+        # Dict, list of dicts or dataframe of raw predictors to feature matrix
+        if isinstance(data, dict):
+            data = [data]
+        columns = data if not isinstance(data, list) else {col: [record[col] for record in data]
+                                                           for col in list(self.ohe_positions) + [col for col, _ in self.int_positions]}
+        n_rows = len(data)
+
+        x = np.zeros((n_rows, len(self.feature_names)), dtype = np.float64)
+        rows = np.arange(n_rows)
+        for col, i in self.int_positions:
+            x[:, i] = np.asarray(columns[col], dtype = np.float64)
+        for col, positions in self.ohe_positions.items():
+            try:
+                x[rows, [positions[category] for category in columns[col]]] = 1.0
+            except KeyError as e:
+                raise ValueError("Found unknown category {} in column {}.".format(e, col))
+        return x
+
+    def predict_proba(self, x: np.ndarray) -> np.ndarray:
+        # Probability of last class per row of feature matrix
+        x = np.asarray(x)
+        if self.kind == "linear":
+            # Same precision, layout and product shape as sklearn on a dataframe, so float32
+            # coefficients (fitted on float32 data) round the same way
+            coef, intercept = self.arrays["coef"], self.arrays["intercept"]
+            x = np.asfortranarray(x, dtype = coef.dtype)
+            return sigmoid((x @ coef.T + intercept.reshape(1, -1)).reshape(-1))
+
+        leaves = self.trees.leaves(x)
+        value = self.arrays["value"][leaves]
+        if self.meta["aggregation"] == "mean":
+            # Tree by tree, same order of summation as sklearn
+            return np.cumsum(value, axis = 1)[:, -1] / value.shape[1]
+
+        # xgboost accumulates margin in float32, starting from base margin
+        margin = np.concatenate([np.full((len(x), 1), self.meta["base_margin"]), value], axis = 1)
+        return sigmoid(np.cumsum(margin.astype(np.float32), axis = 1, dtype = np.float32)[:, -1])
+
+class TreeEnsemble:
+    """
+    All trees of an artifact compiled into packed node arrays. Leaves point to themselves
+    and never send a row away, so traversal needs no leaf check. A single row walks all
+    trees down a fixed number of levels, larger batches walk blocks of (row, tree) pairs and
+    drop the ones that reached a leaf every few levels.
+    """
+    block_rows = 1024
+    compact_steps = 5
+
+    def __init__(self, arrays: dict, decision: str):
+        left, right = arrays["left"], arrays["right"]
+        nodes = np.arange(len(left))
+        self.is_leaf = left == -1
+        self.left = np.where(self.is_leaf, nodes, left).astype(np.intp)
+        self.right = np.where(self.is_leaf, nodes, right).astype(np.intp)
+        self.children = np.stack([self.left, self.right], axis = 1).ravel()
+        self.feature = arrays["feature"].astype(np.intp)
+        self.threshold = np.where(self.is_leaf, np.inf, arrays["threshold"])
+        self.default_left = arrays["default_left"]
+        self.root = arrays["root"].astype(np.intp)
+        self.decision = decision
+
+        # Deepest leaf, number of levels single row path walks
+        self.max_depth = 0
+        frontier = self.root[~self.is_leaf[self.root]]
+        while len(frontier) > 0:
+            self.max_depth += 1
+            frontier = np.concatenate([self.left[frontier], self.right[frontier]])
+            frontier = frontier[~self.is_leaf[frontier]]
+
+    def step(self, value: np.ndarray, node: np.ndarray, has_nan: bool) -> np.ndarray:
+        # sklearn goes left on <=, xgboost on <, missing values follow default direction
+        if self.decision == "le":
+            go_right = value > self.threshold[node]
+        else:
+            go_right = value >= self.threshold[node]
+        if has_nan:
+            go_right = np.where(np.isnan(value), ~self.default_left[node], go_right)
+        return self.children[2 * node + go_right]
+
+    def leaves(self, x: np.ndarray) -> np.ndarray:
+        # Leaf reached by every row in every tree, shape (rows, trees)
+        # Features compared in float32, as both sklearn and xgboost do
+        x = np.asarray(x, dtype = np.float32).astype(np.float64)
+        has_nan = bool(np.isnan(x).any())
+        if len(x) == 1:
+            return self.leaf_of_row(x[0], has_nan)[None, :]
+        return np.concatenate([self.leaves_large(x[start:start + self.block_rows], has_nan)
+                               for start in range(0, len(x), self.block_rows)])
+
+    def leaf_of_row(self, x: np.ndarray, has_nan: bool) -> np.ndarray:
+        # Batch of 1: all trees walk together, fewest numpy calls per level matter most
+        node = self.root
+        for _ in range(self.max_depth):
+            node = self.step(x[self.feature[node]], node, has_nan)
+        return node
+
+    def leaves_large(self, x: np.ndarray, has_nan: bool) -> np.ndarray:
+        # Pairs in tree major order so consecutive pairs share node arrays of one tree
+        n_rows, n_features = x.shape
+        node = np.repeat(self.root, n_rows)
+        result = node.copy()
+        position = np.arange(len(node))
+        offset = np.tile(np.arange(n_rows) * n_features, len(self.root))
+        x = x.ravel()
+
+        while len(position) > 0:
+            for _ in range(self.compact_steps):
+                node = self.step(x[offset + self.feature[node]], node, has_nan)
+
+            # Keep only pairs still travelling
+            done = self.is_leaf[node]
+            result[position[done]] = node[done]
+            running = ~done
+            position, node, offset = position[running], node[running], offset[running]
+
+        return result.reshape(len(self.root), n_rows).T
+
+def load_artifact(model_path: str, model_uid: str = None):
+    # Compact model exported with the pickle, None when missing or of another model
+    try:
+        compact_model = CompactModel(artifact_path(model_path))
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    if model_uid is not None and compact_model.model_uid != model_uid:
+        return None
+    return compact_model
@@ -0,0 +1,500 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import yaml
+
+import util as util
+import data_pipeline as data_pipeline
+import preprocessing as preprocessing
+import inference as inference
+import artifact as artifact
+import modeling as modeling
+import neighbors as neighbors
+
+def random_predictors(config_data: dict, n_rows: int, seed: int = 42) -> pd.DataFrame:
+    # Generate valid predictor rows from config ranges
+    rng = np.random.default_rng(seed)
+    data = dict()
+    for col in config_data["predictor_columns"]:
+        if col in config_data["object_columns"]:
+            data[col] = rng.choice(np.array(config_data[f"{col}_range"], dtype = object), n_rows)
+        else:
+            data[col] = rng.integers(config_data[f"{col}_range"]["min"], config_data[f"{col}_range"]["max"] + 1, n_rows)
+    return pd.DataFrame(data)
+
+def timeit(func, repeat: int = 1) -> float:
+    # Return best wall time of several runs
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_feature_encoder(config_data: dict, sizes: list = [1, 1000, 1000000]) -> None:
+    context = inference.get_context(config_data)
+    encoder = context.feature_encoder
+
+    def ohe_pipeline(data):
+        for col in inference.ohe_columns:
+            data = preprocessing.ohe_transform(data, col, config_data[f"ohe_{col}_path"], ohe = context.ohe_encoders[col])
+        return data
+
+    print(f"{'rows':>10} {'ohe_transform us/row':>22} {'FeatureEncoder us/row':>22} {'from records us/row':>20} {'speedup':>8} {'identical':>10}")
+    for n_rows in sizes:
+        data = random_predictors(config_data, n_rows)
+        repeat = 5 if n_rows <= 1000 else 1
+
+        # Check output matches current pipeline
+        expected = ohe_pipeline(data)
+        encoded = encoder.transform(data)
+        identical = expected.columns.to_list() == encoder.feature_names and \
+            np.array_equal(expected.to_numpy(dtype = np.float64), encoded.astype(np.float64))
+
+        old_time = timeit(lambda: ohe_pipeline(data), repeat) / n_rows * 1e6
+        new_time = timeit(lambda: encoder.transform(data), repeat) / n_rows * 1e6
+
+        # Records input, as received by the API
+        records = data.to_dict("records") if n_rows <= 100000 else None
+        records_time = f"{timeit(lambda: encoder.transform(records), repeat) / n_rows * 1e6:.3f}" if records else "-"
+
+        print(f"{n_rows:>10} {old_time:>22.3f} {new_time:>22.3f} {records_time:>20} {old_time / new_time:>7.1f}x {str(identical):>10}")
+
+def validator_paths_identical(validator: data_pipeline.SchemaValidator, config_data: dict) -> bool:
+    # Per record checks of small batches and vectorized checks must report the same errors,
+    # on records with every kind of bad value an API client may send
+    records = random_predictors(config_data, validator.small_batch).to_dict("records")
+    bad_values = [True, False, "12", "abc", 30.5, None, float("nan"), 0, 10 ** 9]
+    for i, record in enumerate(records):
+        record["Age"] = bad_values[i % len(bad_values)]
+        if i % 3 == 0:
+            record["JobLevel"] = bool(i % 2)
+        if i % 5 == 0:
+            record["OverTime"] = True
+        if i % 7 == 0:
+            record["Department"] = [record["Department"]] if i % 2 else {"name": record["Department"]}
+
+    by_record = validator.error_messages(records).to_list()
+    vectorized = validator.error_messages(pd.DataFrame(records)).to_list()
+    return by_record == vectorized
+
+def bench_validator(config_data: dict, sizes: list = [1, 1000, 1000000]) -> None:
+    validator = data_pipeline.SchemaValidator(config_data)
+    if not validator_paths_identical(validator, config_data):
+        raise RuntimeError("Per record and vectorized validation report different errors.")
+
+    print(f"{'rows':>10} {'validate us/row':>16} {'error_messages us/row':>22} {'from records us/row':>20} {'invalid rows':>13}")
+    for n_rows in sizes:
+        # About 1% of rows out of range
+        data = random_predictors(config_data, n_rows)
+        bad_rows = np.random.default_rng(0).random(n_rows) < 0.01
+        data.loc[bad_rows, "Age"] = 0
+
+        repeat = 5 if n_rows <= 1000 else 1
+        validate_time = timeit(lambda: validator.validate(data), repeat) / n_rows * 1e6
+        messages_time = timeit(lambda: validator.error_messages(data), repeat) / n_rows * 1e6
+
+        # Records input, as received by the API
+        records = data.to_dict("records") if n_rows <= 100000 else None
+        records_time = f"{timeit(lambda: validator.error_messages(records), repeat) / n_rows * 1e6:.3f}" if records else "-"
+
+        n_invalid = int((~validator.validate(data)[0]).sum())
+        print(f"{n_rows:>10} {validate_time:>16.3f} {messages_time:>22.3f} {records_time:>20} {n_invalid:>13}")
+
+def start_api(config_data: dict, overrides: dict) -> subprocess.Popen:
+    # Run API in its own process with overridden config
+    config_file = tempfile.NamedTemporaryFile("w", suffix = ".yaml", delete = False)
+    yaml.safe_dump({**config_data, **overrides}, config_file)
+    config_file.close()
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(__file__), "api.py")],
+        env = {**os.environ, "CONFIG_PATH": config_file.name},
+        stdout = subprocess.DEVNULL,
+        stderr = subprocess.DEVNULL
+    )
+
+    # Wait until API answers
+    import httpx
+    url = f"http://127.0.0.1:{overrides['api_port']}"
+    for _ in range(600):
+        try:
+            httpx.get(url)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+
+    server.terminate()
+    raise RuntimeError("API did not start.")
+
+async def load_generator(url: str, payload: dict, concurrency: int, n_requests: int) -> dict:
+    import httpx
+
+    latencies = list()
+    status = dict()
+    remaining = [n_requests]
+
+    async def client(session):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                response = await session.post(url, json = payload)
+                code = response.status_code
+            except httpx.TransportError:
+                code = "error"
+            latencies.append(time.perf_counter() - start)
+            status[code] = status.get(code, 0) + 1
+
+    limits = httpx.Limits(max_connections = concurrency)
+    async with httpx.AsyncClient(limits = limits, timeout = 60) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1e3
+    return {"throughput": n_requests / elapsed,
+            "p50": np.percentile(latencies, 50),
+            "p99": np.percentile(latencies, 99),
+            "status": status}
+
+def bench_api_load(config_data: dict, sizes: list = [1, 8, 64], n_requests: int = 500, modes: dict = None) -> None:
+    # Sync mode is the previous handler: plain def on starlette's threadpool. Batching is off
+    # in both modes, so only the handler differs
+    if modes is None:
+        modes = {"sync": {"api_async": False, "api_batching": False}, "async": {"api_async": True, "api_batching": False}}
+
+    payload = random_predictors(config_data, 1).iloc[0].to_dict()
+    payload = {col: value.item() if hasattr(value, "item") else value for col, value in payload.items()}
+
+    print(f"{'mode':>10} {'clients':>8} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10}  status")
+    for mode, overrides in modes.items():
+        # Every request sends the same record, with cache on it would measure cache lookups
+        overrides = {"api_host": "127.0.0.1", "api_port": 8099, "print_debug": False, "cache_enabled": False, **overrides}
+        server = start_api(config_data, overrides)
+        try:
+            url = f"http://127.0.0.1:{overrides['api_port']}/predict/"
+            for concurrency in sizes:
+                res = asyncio.run(load_generator(url, payload, concurrency, n_requests))
+                print(f"{mode:>10} {concurrency:>8} {res['throughput']:>10.1f} {res['p50']:>10.2f} {res['p99']:>10.2f}  {res['status']}")
+        finally:
+            server.terminate()
+            server.wait()
+
+def bench_api_batching(config_data: dict, sizes: list = [1, 8, 64, 256]) -> None:
+    # Deep queue so that both modes serve every request
+    bench_api_load(config_data, sizes, modes = {
+        "unbatched": {"api_batching": False, "api_queue_depth": 1024},
+        "batched": {"api_batching": True, "api_queue_depth": 1024}
+    })
+
+def process_tree_pss_mb(pid: int) -> float:
+    # Proportional set size of process and its descendants, shared pages are counted once
+    pss = 0
+    pids = [pid]
+    while len(pids) > 0:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/smaps_rollup", "r") as file:
+                pss += sum(int(line.split()[1]) for line in file if line.startswith("Pss:"))
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children", "r") as file:
+                    pids.extend(int(child) for child in file.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+    return pss / 1024
+
+def child_pids(pid: int) -> list:
+    # Direct children of a process
+    pids = list()
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children", "r") as file:
+            pids.extend(int(child) for child in file.read().split())
+    return pids
+
+def process_memory_mb(pid: int) -> dict:
+    # Resident, proportional and private (unique) set size of one process
+    memory = {"Rss": 0, "Pss": 0, "Private": 0}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as file:
+        for line in file:
+            name, value = line.split()[:2]
+            for key in memory:
+                if name.startswith(key):
+                    memory[key] += int(value)
+    return {key: value / 1024 for key, value in memory.items()}
+
+def bench_api_processes(config_data: dict, sizes: list = [2, 4], n_requests: int = 200) -> None:
+    """
+    Memory of multi-process serving: independent uvicorn workers, each loading its own
+    context, against workers forked from one preloaded parent.
+    """
+    payload = random_predictors(config_data, 1).iloc[0].to_dict()
+    payload = {col: value.item() if hasattr(value, "item") else value for col, value in payload.items()}
+
+    print(f"{'mode':>8} {'workers':>8} {'RSS MB/worker':>14} {'private MB/worker':>18} {'total PSS MB':>13}")
+    for workers in sizes:
+        for mode, prefork in [("naive", False), ("prefork", True)]:
+            # Explainer loaded at startup, so workers hold the same objects in both modes
+            overrides = {"api_host": "127.0.0.1", "api_port": 8099, "print_debug": False, "api_processes": workers,
+                         "api_prefork": prefork, "preload_explainer": True, "cache_enabled": False}
+            server = start_api(config_data, overrides)
+            try:
+                # Let every worker finish loading, then serve some explained requests
+                previous = -1
+                while abs(process_tree_pss_mb(server.pid) - previous) > 1:
+                    previous = process_tree_pss_mb(server.pid)
+                    time.sleep(1)
+                asyncio.run(load_generator(f"http://127.0.0.1:{overrides['api_port']}/predict/", payload, workers, n_requests))
+
+                pids = [pid for pid in child_pids(server.pid) if "resource_tracker" not in open(f"/proc/{pid}/cmdline").read()]
+                memory = [process_memory_mb(pid) for pid in pids]
+                print(f"{mode:>8} {len(pids):>8} {np.mean([m['Rss'] for m in memory]):>14.1f} "
+                      f"{np.mean([m['Private'] for m in memory]):>18.1f} {process_tree_pss_mb(server.pid):>13.1f}")
+            finally:
+                server.terminate()
+                server.wait()
+
+def training_data_case(mode: str, data_dir: str, workers: int) -> None:
+    # Parallel fits as in modeling.train_eval, data passed as pickled frames or as array handles
+    from sklearn.tree import DecisionTreeClassifier
+    from concurrent.futures import ProcessPoolExecutor
+
+    if mode == "pickle":
+        x_train = util.pickle_load(os.path.join(data_dir, "x_train.pkl"))
+        y_train = util.pickle_load(os.path.join(data_dir, "y_train.pkl"))
+    else:
+        x_train = util.ArrayHandle(os.path.join(data_dir, "x_train.npy"), util.pickle_load(os.path.join(data_dir, "columns.pkl")))
+        y_train = util.ArrayHandle(os.path.join(data_dir, "y_train.npy"), name = "Attrition")
+
+    tasks = list()
+    for max_depth in [4, 6, 8, 10]:
+        model = {"model_name": f"DecisionTree{max_depth}", "model_object": DecisionTreeClassifier(max_depth = max_depth), "model_uid": ""}
+        tasks.append(("Benchmark", "No sampling", model, x_train, y_train, x_train, y_train, 42, 1))
+
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        list(executor.map(modeling.train_eval_task, *zip(*tasks)))
+
+def bench_training_data(config_data: dict, sizes: list = [10000, 100000, 1000000], workers: int = 2) -> None:
+    ohe_encoders = {col: util.pickle_load(config_data[f"ohe_{col}_path"]) for col in inference.ohe_columns}
+    encoder = preprocessing.FeatureEncoder(ohe_encoders, [col for col in config_data["predictor_columns"] if col in config_data["int64_columns"]])
+
+    print(f"{'rows':>10} {'mode':>8} {'wall s':>8} {'peak PSS MB':>12}")
+    for n_rows in sizes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            # Same float64 rows in both formats, as preprocessing writes them
+            x_train = encoder.transform_frame(random_predictors(config_data, n_rows))
+            y_train = pd.Series(np.random.default_rng(0).integers(0, 2, n_rows), name = "Attrition")
+            util.pickle_dump(x_train.astype(np.float64), os.path.join(data_dir, "x_train.pkl"))
+            util.pickle_dump(y_train, os.path.join(data_dir, "y_train.pkl"))
+            util.pickle_dump(x_train.columns.to_list(), os.path.join(data_dir, "columns.pkl"))
+            util.array_dump(x_train, os.path.join(data_dir, "x_train.npy"), np.float64)
+            util.array_dump(y_train, os.path.join(data_dir, "y_train.npy"), np.int8)
+            del x_train, y_train
+
+            for mode in ["pickle", "memmap"]:
+                # Fresh interpreter per case, memory sampled over the whole process tree
+                code = f"import benchmark; benchmark.training_data_case({mode!r}, {data_dir!r}, {workers})"
+                start = time.perf_counter()
+                case = subprocess.Popen([sys.executable, "-c", code], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                        env = {**os.environ, "CONFIG_PATH": os.path.abspath(util.config_dir)})
+                peak = 0
+                while case.poll() is None:
+                    peak = max(peak, process_tree_pss_mb(case.pid))
+                    time.sleep(0.02)
+                wall_time = time.perf_counter() - start
+
+                if case.returncode != 0:
+                    raise RuntimeError(f"Training data benchmark failed for {mode}.")
+                print(f"{n_rows:>10} {mode:>8} {wall_time:>8.2f} {peak:>12.1f}")
+
+def dataset_format_case(file_path: str, columns: list = None) -> None:
+    # Load time and memory of one load, in a fresh process with libraries already imported
+    import json
+    import pyarrow.feather
+    util.reset_peak_memory()
+    baseline = util.peak_memory_mb()
+    start = time.perf_counter()
+    if file_path.endswith(".pkl"):
+        data = util.pickle_load(file_path)
+        data = data[columns] if columns is not None else data
+    else:
+        data = util.dataset_load(file_path, columns)
+    print(json.dumps([time.perf_counter() - start, util.peak_memory_mb() - baseline]))
+
+def bench_dataset_format(config_data: dict, sizes: list = [10000, 100000, 1000000]) -> None:
+    # Stage that needs a few columns only
+    projection = config_data["predictor_columns"][:3]
+
+    print(f"{'rows':>10} {'format':>8} {'size MB':>8} {'load s':>8} {'load MB':>8} {'3 cols s':>9} {'3 cols MB':>10}")
+    for n_rows in sizes:
+        # Shuffled index, as train test split leaves it
+        data = random_predictors(config_data, n_rows)
+        data.index = np.random.default_rng(0).permutation(n_rows)
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            file_paths = {"pickle": os.path.join(data_dir, "x_train.pkl"), "arrow": os.path.join(data_dir, "x_train.arrow")}
+            util.pickle_dump(data, file_paths["pickle"])
+            util.dataset_dump(data, file_paths["arrow"])
+
+            for name, file_path in file_paths.items():
+                res = list()
+                for columns in (None, projection):
+                    code = f"import benchmark; benchmark.dataset_format_case({file_path!r}, {columns!r})"
+                    output = subprocess.run([sys.executable, "-c", code], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                            env = {**os.environ, "CONFIG_PATH": os.path.abspath(util.config_dir)},
+                                            capture_output = True, text = True, check = True).stdout
+                    res += yaml.safe_load(output.strip().splitlines()[-1])
+
+                size = os.path.getsize(file_path) / 1024 ** 2
+                print(f"{n_rows:>10} {name:>8} {size:>8.1f} {res[0]:>8.3f} {res[1]:>8.1f} {res[2]:>9.3f} {res[3]:>10.1f}")
+
+# Cold start of a serving worker up to first prediction, run with python -c so that only
+# what the case imports is loaded
+artifact_startup_cases = {
+    "pickle": """
+import joblib, numpy as np, pandas as pd
+model = joblib.load(model_path)["model_data"]["model_object"]
+model.predict_proba(pd.DataFrame(np.zeros((1, len(model.feature_names_in_))), columns = model.feature_names_in_))
+""",
+    "artifact": """
+import artifact, numpy as np
+model = artifact.CompactModel(artifact.artifact_path(model_path))
+model.predict_proba(np.zeros((1, len(model.feature_names))))
+"""
+}
+
+def bench_artifact(config_data: dict, sizes: list = [1, 1000, 100000]) -> None:
+    context = inference.get_context(config_data)
+    compact_model = artifact.load_artifact(context.model_path, context.model_uid)
+    if compact_model is None:
+        raise RuntimeError("No artifact exported for model {}.".format(context.model_uid))
+
+    print(f"{'rows':>10} {'model us/row':>13} {'artifact us/row':>16} {'max abs diff':>13}")
+    for n_rows in sizes:
+        data = context.encode(random_predictors(config_data, n_rows))
+        x = data.to_numpy()
+        repeat = 20 if n_rows <= 1000 else 1
+
+        model_time = timeit(lambda: context.model.predict_proba(data), repeat) / n_rows * 1e6
+        artifact_time = timeit(lambda: compact_model.predict_proba(x), repeat) / n_rows * 1e6
+        diff = np.abs(context.model.predict_proba(data)[:, 1] - compact_model.predict_proba(x)).max()
+        print(f"{n_rows:>10} {model_time:>13.1f} {artifact_time:>16.1f} {diff:>13.2e}")
+
+    # Cold start of a serving worker, each case in a fresh interpreter
+    print(f"{'startup':>10} {'to first prediction s':>22} {'peak RSS MB':>12}")
+    for name, case in artifact_startup_cases.items():
+        code = f"model_path = {os.path.abspath(context.model_path)!r}\n{case}"
+        _, wall_time, peak, _ = cold_start("", code, os.path.dirname(os.path.abspath(__file__)))
+        print(f"{name:>10} {wall_time:>22.3f} {peak:>12.1f}")
+
+def cold_start(import_code: str, first_code: str, cwd: str, src_path: bool = True) -> tuple:
+    # Import time, time to first result, peak RSS and heavy modules loaded, in a fresh interpreter
+    code = "import sys, time\n" + f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})\n" * src_path + \
+        f"start = time.perf_counter()\n{import_code}\nimported = time.perf_counter()\n{first_code}\n" + \
+        "print(imported - start, time.perf_counter() - start, " + \
+        "[line for line in open('/proc/self/status') if line.startswith('VmHWM')][0].split()[1], " + \
+        f"','.join(name for name in {startup_heavy_modules!r} if name in sys.modules) or '-')"
+    process = subprocess.run([sys.executable, "-c", code], cwd = cwd, capture_output = True, text = True,
+                             env = {**os.environ, "CONFIG_PATH": os.path.abspath(util.config_dir)})
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    import_time, wall_time, peak, modules = process.stdout.split()[-4:]
+    return float(import_time), float(wall_time), int(peak) / 1024, modules
+
+# Modules serving should not load before they are needed
+startup_heavy_modules = ["shap", "sklearn", "xgboost", "matplotlib", "joblib"]
+
+startup_cases = {
+    # Import, then first prediction of a record without explanation
+    "api": ("import api, inference", """
+inference.load_context(api.config_data)
+record = {col: api.config_data["missing_value_handling"][col] for col in api.config_data["predictor_columns"]}
+api.predict_record_batch([(api.api_data(**record), "none", 3)])
+""", True),
+    # Import, then first render of the form. src is left off sys.path, app script is
+    # named like the package and streamlit adds its folder when running it
+    "streamlit": ("import streamlit", f"""
+from streamlit.testing.v1 import AppTest
+AppTest.from_file({os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit.py")!r}).run(timeout = 60)
+""", False)
+}
+
+def bench_startup(config_data: dict, sizes: list = [3]) -> None:
+    """
+    Cold start of API worker and Streamlit app. Fails when serving imports one of the
+    heavy modules before first request needs it, so startup regressions show up here.
+    """
+    print(f"{'app':>10} {'import s':>9} {'to first prediction s':>22} {'peak RSS MB':>12}  heavy modules")
+    regressions = list()
+    for name, (import_code, first_code, src_path) in startup_cases.items():
+        # Best of a few runs, first one also warms disk cache
+        try:
+            runs = [cold_start(import_code, first_code, os.getcwd(), src_path) for _ in range(sizes[0])]
+        except RuntimeError as re:
+            raise RuntimeError(f"Startup benchmark failed for {name}: {re}")
+        import_time, wall_time, peak, modules = min(runs, key = lambda run: run[1])
+        print(f"{name:>10} {import_time:>9.3f} {wall_time:>22.3f} {peak:>12.1f}  {modules}")
+        if modules != "-":
+            regressions.append(f"{name} loads {modules}")
+
+    if len(regressions) > 0:
+        raise RuntimeError("Startup regression: {}.".format(", ".join(regressions)))
+
+def bench_neighbors(config_data: dict, sizes: list = [10000, 100000, 1000000], n_queries: int = 1000, k: int = 5) -> None:
+    """
+    Fit time, query time and recall of every neighbors backend against exact brute force
+    search, on encoded predictors as KNN model and SMOTE see them.
+    """
+    ohe_encoders = {col: util.pickle_load(config_data[f"ohe_{col}_path"]) for col in inference.ohe_columns}
+    encoder = preprocessing.FeatureEncoder(ohe_encoders, [col for col in config_data["predictor_columns"] if col in config_data["int64_columns"]])
+    backends = [("brute", {}), ("kd_tree", {}), ("ball_tree", {})] + \
+        [("ivf", {"ivf_n_probe": n_probe}) for n_probe in [2, 8, 32]]
+
+    print(f"{'rows':>10} {'backend':>12} {'fit s':>8} {'query us/row':>13} {'recall@' + str(k):>9}")
+    for n_rows in sizes:
+        x = encoder.transform(random_predictors(config_data, n_rows)).astype(np.float64)
+        queries = encoder.transform(random_predictors(config_data, n_queries, seed = 7)).astype(np.float64)
+
+        exact_distances = None
+        for backend, overrides in backends:
+            index = neighbors.create_index({**config_data, "neighbors_backend": backend, **overrides}, k)
+            fit_time = timeit(lambda: index.fit(x))
+            query_time = timeit(lambda: index.kneighbors(queries, return_distance = False)) / n_queries * 1e6
+
+            # First backend is brute force, the exact reference
+            distances, _ = index.kneighbors(queries)
+            if exact_distances is None:
+                exact_distances = distances
+            name = backend if len(overrides) == 0 else f"{backend}/{overrides['ivf_n_probe']}"
+            print(f"{n_rows:>10} {name:>12} {fit_time:>8.3f} {query_time:>13.1f} {neighbors.recall(distances, exact_distances):>9.3f}")
+
+benchmarks = {
+    "feature_encoder": bench_feature_encoder,
+    "validator": bench_validator,
+    "api_load": bench_api_load,
+    "api_batching": bench_api_batching,
+    "api_processes": bench_api_processes,
+    "training_data": bench_training_data,
+    "dataset_format": bench_dataset_format,
+    "artifact": bench_artifact,
+    "startup": bench_startup,
+    "neighbors": bench_neighbors,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Performance benchmarks")
+    parser.add_argument("name", choices = list(benchmarks))
+    parser.add_argument("--sizes", type = int, nargs = "+", help = "Rows or concurrent clients, depending on benchmark")
+    args = parser.parse_args()
+
+    config_data = util.load_config()
+    if args.sizes is None:
+        benchmarks[args.name](config_data)
+    else:
+        benchmarks[args.name](config_data, args.sizes)
@@ -1,18 +1,120 @@
 import pandas as pd
 import numpy as np
-import yaml
 import os
-import tqdm
 import util
 
-from sklearn.model_selection import train_test_split
-
 def read_raw_data(config: dict) -> pd.DataFrame:
     raw_data_path = config['raw_dataset_path']
     selected_columns = config['int64_columns'] + config['object_columns']
-    df = pd.read_csv(raw_data_path)[selected_columns]
+    df = pd.read_csv(raw_data_path, usecols = selected_columns)[selected_columns]
     return df
 
+class SchemaValidator:
+    """
+    Validator compiled once from config. Checks type, category membership and int range
+    of every column for the whole frame in one vectorized pass.
+    """
+    # Number of records below which per record checks beat vectorized pass
+    small_batch = 64
+
+    def __init__(self, params: dict, columns: list = None):
+        # Default to predictor columns, as received by API
+        self.columns = columns if columns is not None else params["predictor_columns"]
+
+        self.categories = dict()
+        self.category_sets = dict()
+        self.int_ranges = dict()
+        for col in self.columns:
+            if col in params["object_columns"]:
+                self.categories[col] = pd.Index(params[f"{col}_range"])
+                self.category_sets[col] = set(params[f"{col}_range"])
+            else:
+                self.int_ranges[col] = (params[f"{col}_range"]["min"], params[f"{col}_range"]["max"])
+
+    def check_column(self, values: pd.Series, col: str) -> list:
+        # Return list of (invalid row mask, error message)
+        # Categories are strings, anything else (lists and dicts included) is out of range
+        if col in self.categories:
+            if values.dtype == object:
+                is_str = np.fromiter((isinstance(value, str) for value in values), dtype = bool, count = len(values))
+                values = values.where(is_str)
+            return [(self.categories[col].get_indexer(values) < 0, f"Error occurs in {col} column range")]
+
+        # Int column may arrive as int, float (with NaN) or object, bools are not ints
+        checks = list()
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            values = values.to_numpy()
+        else:
+            is_bool = np.fromiter((isinstance(value, (bool, np.bool_)) for value in values), dtype = bool, count = len(values))
+            values = np.where(is_bool, np.nan, pd.to_numeric(values, errors = "coerce").to_numpy(dtype = np.float64, na_value = np.nan))
+
+        if not np.issubdtype(values.dtype, np.integer):
+            invalid_type = np.isnan(values) | (values % 1 != 0)
+            checks.append((invalid_type, f"Error occurs in {col} column type"))
+
+        # NaN compares False, so type errors are not reported twice
+        checks.append(((values < self.int_ranges[col][0]) | (values > self.int_ranges[col][1]), f"Error occurs in {col} column range"))
+        return checks
+
+    def validate(self, input_data: pd.DataFrame) -> tuple:
+        """
+        Return boolean mask of valid rows and dataframe of errors with columns row, column and error.
+        """
+        checks = list()
+        for col in self.columns:
+            # Missing column fails every row
+            if col not in input_data.columns:
+                checks.append((col, np.ones(len(input_data), dtype = bool), f"{col} is missing"))
+            else:
+                checks += [(col, invalid, message) for invalid, message in self.check_column(input_data[col], col)]
+
+        invalid = np.column_stack([check[1] for check in checks]) if len(checks) > 0 else np.zeros((len(input_data), 0), dtype = bool)
+        mask = ~invalid.any(axis = 1)
+
+        # Only failed cells are materialized
+        rows, cols = np.nonzero(invalid)
+        errors = pd.DataFrame({
+            "row" : input_data.index[rows],
+            "column" : np.array([check[0] for check in checks], dtype = object)[cols],
+            "error" : np.array([check[2] for check in checks], dtype = object)[cols]
+        })
+
+        return mask, errors
+
+    def record_errors(self, record: dict) -> list:
+        # Plain python checks, cheaper than vectorized pass for a handful of records
+        errors = list()
+        for col in self.columns:
+            if col not in record:
+                errors.append(f"{col} is missing")
+            elif col in self.category_sets:
+                if not isinstance(record[col], str) or record[col] not in self.category_sets[col]:
+                    errors.append(f"Error occurs in {col} column range")
+            else:
+                try:
+                    value = np.nan if isinstance(record[col], (bool, np.bool_)) else float(record[col])
+                except (TypeError, ValueError):
+                    value = np.nan
+                if np.isnan(value) or value % 1 != 0:
+                    errors.append(f"Error occurs in {col} column type")
+                if value < self.int_ranges[col][0] or value > self.int_ranges[col][1]:
+                    errors.append(f"Error occurs in {col} column range")
+        return errors
+
+    def error_messages(self, input_data) -> pd.Series:
+        # List of records, small enough for per record checks
+        if isinstance(input_data, list) and len(input_data) <= self.small_batch:
+            return pd.Series([", ".join(self.record_errors(record)) for record in input_data], dtype = object)
+        if isinstance(input_data, list):
+            input_data = pd.DataFrame(input_data)
+
+        # One message per row, empty string means the row is valid
+        mask, errors = self.validate(input_data)
+        res = pd.Series("", index = input_data.index, dtype = object)
+        if not mask.all():
+            res.update(errors.groupby("row", sort = False)["error"].agg(", ".join))
+        return res
+
 def check_data(input_data, params, api=False):
     if api == False:
         """
@@ -22,13 +124,7 @@ def check_data(input_data, params, api=False):
         assert input_data.select_dtypes("object").columns.to_list() == params["object_columns"], "Error occurs in object columns"
         assert input_data.select_dtypes("int64").columns.to_list() == params["int64_columns"], "Error occurs in object columns"
 
-        # Range data checking for obj columns
-        for col in config_data["object_columns"]:
-            assert set(input_data[f"{col}"]).issubset(set(params[f"{col}_range"])), f"Error occurs in {col} column range"
-
-        # Range data checking for int64 columns
-        for col in config_data["int64_columns"]:
-            assert input_data[f"{col}"].between(params[f"{col}_range"]["min"], params[f"{col}_range"]["max"]).sum() == len(input_data), f"Error occurs in {col} column range"
+        columns = params["object_columns"] + params["int64_columns"]
     else:
         """
         If the data input coming from API, then we only check columns that selected as predictor
@@ -42,19 +138,20 @@ def check_data(input_data, params, api=False):
         assert input_object_columns == expected_object_columns, f"Error occurs in object columns, {expected_object_columns - input_object_columns}"
         assert input_int64_columns == expected_int64_columns, f"Error occurs in int64 columns, {expected_int64_columns - input_int64_columns}"
 
-        # Range data checking for obj columns
-        for col in (set(params["object_columns"]) & set(params["predictor_columns"])):
-            assert set(input_data[f"{col}"]).issubset(set(params[f"{col}_range"])), f"Error occurs in {col} column range"
+        columns = params["predictor_columns"]
 
-        # Range data checking for int64 columns
-        for col in (set(params["int64_columns"]) & set(params["predictor_columns"])):
-            assert input_data[f"{col}"].between(params[f"{col}_range"]["min"], params[f"{col}_range"]["max"]).sum() == len(input_data), f"Error occurs in {col} column range"
+    # Range data checking for obj and int64 columns
+    mask, errors = SchemaValidator(params, columns).validate(input_data)
+    assert mask.all(), errors["error"].iloc[0] if len(errors) > 0 else "Error occurs in data range"
 
 if __name__ == "__main__":
+    # Only needed for splitting, serving imports this module for the validator alone
+    from sklearn.model_selection import train_test_split
+
     config_data = util.load_config()
 
     raw_dataset = read_raw_data(config_data)
-    util.pickle_dump(raw_dataset, config_data["raw_dataset_collected_path"])
+    util.dataset_dump(raw_dataset, config_data["raw_dataset_collected_path"])
 
     check_data(raw_dataset, config_data, api=False)
 
@@ -64,12 +161,12 @@ if __name__ == "__main__":
     x_train, x_test, y_train, y_test = train_test_split(x, y, test_size = 0.3, random_state = 42, stratify = y)
     x_valid, x_test, y_valid, y_test = train_test_split(x_test, y_test, test_size = 0.5, random_state = 42, stratify = y_test)
 
-    util.pickle_dump(x_train, config_data["train_set_path"]["x"])
-    util.pickle_dump(y_train, config_data["train_set_path"]["y"])
+    util.dataset_dump(x_train, config_data["train_set_path"]["x"])
+    util.dataset_dump(y_train, config_data["train_set_path"]["y"])
 
-    util.pickle_dump(x_valid, config_data["valid_set_path"]["x"])
-    util.pickle_dump(y_valid, config_data["valid_set_path"]["y"])
+    util.dataset_dump(x_valid, config_data["valid_set_path"]["x"])
+    util.dataset_dump(y_valid, config_data["valid_set_path"]["y"])
 
-    util.pickle_dump(x_test, config_data["test_set_path"]["x"])
-    util.pickle_dump(y_test, config_data["test_set_path"]["y"])
+    util.dataset_dump(x_test, config_data["test_set_path"]["x"])
+    util.dataset_dump(y_test, config_data["test_set_path"]["y"])
 
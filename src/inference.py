@@ -0,0 +1,203 @@
+import os
+import numpy as np
+import pandas as pd
+import threading
+
+import util as util
+import preprocessing as preprocessing
+import registry as registry
+import artifact as artifact
+
+# Categorical predictors encoded by one hot encoder, in the same order as training
+ohe_columns = ["Department", "JobRole", "OverTime"]
+
+class InferenceContext:
+    """
+    Warm inference objects: encoders, production model and SHAP explainer are loaded once
+    and shared by every request instead of being reloaded from disk per call. When the
+    model artifact was exported from this very model file, serving starts from the artifact
+    alone and the pickle, sklearn and shap are loaded on first use.
+    """
+    # Largest batch predicted by compact artifact, bigger batches are faster on the model itself
+    compact_max_rows = 1000
+
+    def __init__(self, config_data: dict, model_path: str = None):
+        self.config_data = config_data
+        self.loaded = dict()
+        self.load_lock = threading.RLock()
+
+        # Model file and its modification time, used by watcher to detect new version
+        self.model_path = model_path if model_path is not None else registry.resolve_model_path(config_data)
+        self.model_signature = model_signature(self.model_path)
+        int_columns = [col for col in config_data["predictor_columns"] if col in config_data["int64_columns"]]
+
+        # Exported artifact of the same model predicts without sklearn and xgboost overhead
+        self.compact_model = None
+        if config_data.get("use_model_artifact", False):
+            self.compact_model = artifact.load_artifact(self.model_path)
+
+        if self.compact_model is not None and self.compact_model.source_digest is not None and \
+           self.compact_model.source_digest == artifact.file_digest(self.model_path):
+            # Artifact belongs to this model file, model UID and encoder layout come from it
+            self.model_uid = self.compact_model.model_uid
+            ohe_categories = self.compact_model.meta["ohe_categories"]
+            self.feature_encoder = preprocessing.FeatureEncoder({col: ohe_categories[col] for col in ohe_columns},
+                                                                int_columns, self.compact_model.feature_names)
+            return
+
+        # Otherwise model and encoders come from pickles, artifact is used only if it matches them
+        self.model_uid = self.model_data["model_data"]["model_uid"]
+
+        # Compile encoders into the model's column layout
+        self.feature_encoder = preprocessing.FeatureEncoder(self.ohe_encoders, int_columns,
+                                                            getattr(self.model, "feature_names_in_", None))
+
+        if self.compact_model is not None and (self.compact_model.model_uid != self.model_uid or
+                                               self.compact_model.feature_names != self.feature_encoder.feature_names):
+            self.compact_model = None
+
+    def lazy(self, name: str, load):
+        # Load heavy object on first use, once even when requests ask for it concurrently
+        if name not in self.loaded:
+            with self.load_lock:
+                if name not in self.loaded:
+                    self.loaded[name] = load()
+        return self.loaded[name]
+
+    @property
+    def model_data(self) -> dict:
+        return self.lazy("model_data", lambda: util.pickle_load(self.model_path))
+
+    @property
+    def model(self):
+        return self.model_data["model_data"]["model_object"]
+
+    @property
+    def ohe_encoders(self) -> dict:
+        return self.lazy("ohe_encoders", lambda: {col: util.pickle_load(self.config_data[f"ohe_{col}_path"]) for col in ohe_columns})
+
+    @property
+    def le_encoder(self):
+        return self.lazy("le_encoder", lambda: util.pickle_load(self.config_data["le_encoder_path"]))
+
+    @property
+    def explainer(self):
+        # shap is imported here, on first explanation
+        return self.lazy("explainer", lambda: create_explainer(self.model))
+
+    def preload(self) -> None:
+        # Load everything lazy up front, e.g. before forking workers that share it
+        self.ohe_encoders
+        self.le_encoder
+        self.explainer
+
+    def encode(self, data) -> pd.DataFrame:
+        return self.feature_encoder.transform_frame(data)
+
+    def predict_proba(self, data: pd.DataFrame):
+        if self.compact_model is not None and len(data) <= self.compact_max_rows:
+            return self.compact_model.predict_proba(data.to_numpy())
+        return self.model.predict_proba(data)[:, 1]
+
+    def explain(self, data: pd.DataFrame, approximate: bool = False) -> dict:
+        import shap
+
+        # Saabas style estimate, only available for tree explainer
+        if approximate and isinstance(self.explainer, shap.TreeExplainer):
+            shap_values = self.explainer.shap_values(data, approximate = True)
+            if isinstance(shap_values, list):
+                shap_values = np.stack(shap_values, axis = -1)
+
+            expected_value = np.asarray(self.explainer.expected_value)
+            return {"shap_values" : shap_values,
+                    "shap_base_values" : np.broadcast_to(expected_value, (len(data),) + expected_value.shape).copy(),
+                    "shap_feature" : data.to_numpy(),
+                    "shap_feature_name" : data.columns}
+
+        # Single explanation pass
+        explanation = self.explainer(data)
+        return {"shap_values" : explanation.values,
+                "shap_base_values" : explanation.base_values,
+                "shap_feature" : explanation.data,
+                "shap_feature_name" : data.columns}
+
+    def warm_up(self, explain: bool = False) -> None:
+        # Run one prediction so first request does not pay lazy initialization. Explaining it
+        # also loads model pickle and explainer, which costs seconds
+        record = {col: self.config_data["missing_value_handling"][col] for col in self.config_data["predictor_columns"]}
+        data = self.encode(record)
+        self.predict_proba(data)
+        if explain:
+            self.explain(data)
+
+def model_signature(model_path: str) -> tuple:
+    return model_path, os.path.getmtime(model_path)
+
+def create_explainer(model):
+    import shap
+
+    # Hyperparams tuned model keeps the fitted estimator in best_estimator_
+    model = getattr(model, "best_estimator_", model)
+
+    # Tree explainer for tree based model, otherwise let shap choose
+    try:
+        return shap.TreeExplainer(model)
+    except Exception:
+        return shap.Explainer(model)
+
+context = None
+context_lock = threading.RLock()
+
+def load_context(config_data: dict, model_path: str = None) -> InferenceContext:
+    global context
+
+    # Build and warm new context, in-flight requests keep using the old one. Explainer is
+    # warmed on startup only when asked for, but always before a swap, so no request after
+    # a reload or pin pays for it
+    util.print_debug("Loading inference context.")
+    new_context = InferenceContext(config_data, model_path)
+    new_context.warm_up(context is not None or config_data.get("preload_explainer", False))
+
+    # Make sure served production model can be rolled back to later, pickle is read only when not registered yet
+    if new_context.model_path == config_data["production_model_path"] and \
+       not os.path.exists(registry.version_path(new_context.model_uid, config_data)):
+        registry.register_model(new_context.model_data, config_data)
+
+    # Swap it in
+    with context_lock:
+        context = new_context
+    util.print_debug("Inference context loaded, serving model {}.".format(new_context.model_uid))
+
+    return new_context
+
+def get_context(config_data: dict = None) -> InferenceContext:
+    # Load lazily for callers that did not load it on startup
+    if context is None:
+        with context_lock:
+            if context is None:
+                return load_context(config_data if config_data is not None else util.load_config())
+    return context
+
+class ModelWatcher(threading.Thread):
+    """
+    Background thread that reloads the inference context when production model file
+    is overwritten or pinned version changes.
+    """
+    def __init__(self, config_data: dict):
+        super().__init__(daemon = True)
+        self.config_data = config_data
+        self.interval = config_data["model_reload_interval"]
+        self.stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            try:
+                signature = model_signature(registry.resolve_model_path(self.config_data))
+                if signature != get_context(self.config_data).model_signature:
+                    load_context(self.config_data, signature[0])
+            except Exception as e:
+                # Keep serving current model if new one can not be loaded
+                util.print_debug("Model reload failed: {}".format(e))
+
+    def stop(self) -> None:
+        self.stop_event.set()
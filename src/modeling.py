@@ -1,34 +1,86 @@
 from sklearn.linear_model import LogisticRegression
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.neighbors import KNeighborsClassifier
 from xgboost import XGBClassifier
 
 from sklearn.metrics import classification_report
-from sklearn.model_selection import RandomizedSearchCV
 
 import json
+import os
+import numpy as np
 import pandas as pd
 import copy
 import hashlib
+from concurrent.futures import ProcessPoolExecutor
 
 import util as util
+import registry as registry
+import artifact as artifact
+import tuning as tuning
+import tracking as tracking
+import neighbors as neighbors
+
+def feng_arrays_available(params: dict) -> bool:
+    # Memory-mapped arrays are used when enabled and written by preprocessing
+    if not params.get("use_memmap", False):
+        return False
+    if not os.path.exists(os.path.join(params["feng_array_path"], "meta.json")):
+        util.print_debug("use_memmap is set but no arrays found in {}, loading Arrow files instead. "
+                         "Run preprocessing.py to write them.".format(params["feng_array_path"]))
+        return False
+    return True
+
+def feng_array_handles(params: dict) -> tuple:
+    # Handles to train, valid and test arrays, loading them is zero-copy
+    array_path = params["feng_array_path"]
+    with open(os.path.join(array_path, "meta.json"), "r") as file:
+        meta = json.load(file)
+
+    def handle(file_name, columns = None, plan_path = None):
+        return util.ArrayHandle(os.path.join(array_path, file_name), columns, meta["target"], plan_path, meta.get("integer"))
+
+    # Every configuration maps the same training arrays, resampled ones through their plan
+    plans = util.resampling_plans(params["resampling_path"])
+    x_train = {configuration: handle("x_train.npy", meta["columns"], plan_path) for configuration, plan_path in plans.items()}
+    y_train = {configuration: handle("y_train.npy", None, plan_path) for configuration, plan_path in plans.items()}
+
+    return x_train, y_train, \
+        handle("x_valid.npy", meta["columns"]), handle("y_valid.npy"), \
+        handle("x_test.npy", meta["columns"]), handle("y_test.npy")
 
 def load_train_feng(params: dict) -> pd.DataFrame:
-    x_train = util.pickle_load(params["train_set_feng_path"]['x'])
-    y_train = util.pickle_load(params["train_set_feng_path"]['y'])
+    if feng_arrays_available(params):
+        x_train, y_train, _, _, _, _ = feng_array_handles(params)
+        return {key: value.load() for key, value in x_train.items()}, {key: value.load() for key, value in y_train.items()}
+
+    x_train = util.dataset_load(params["train_set_feng_path"]['x'])
+    y_train = util.dataset_load(params["train_set_feng_path"]['y'])
+
+    # Resampled configurations are built from the training set by their plan
+    plans = {configuration: None if plan_path is None else util.plan_load(plan_path)
+             for configuration, plan_path in util.resampling_plans(params["resampling_path"]).items()}
+    x_train = {configuration: x_train if plan is None else util.resample(x_train, plan) for configuration, plan in plans.items()}
+    y_train = {configuration: y_train if plan is None else util.resample(y_train, plan) for configuration, plan in plans.items()}
 
     return x_train, y_train
 
 def load_valid_feng(params: dict) -> pd.DataFrame:
-    x_valid = util.pickle_load(params["valid_set_feng_path"]['x'])
-    y_valid = util.pickle_load(params["valid_set_feng_path"]['y'])
+    if feng_arrays_available(params):
+        _, _, x_valid, y_valid, _, _ = feng_array_handles(params)
+        return x_valid.load(), y_valid.load()
+
+    x_valid = util.dataset_load(params["valid_set_feng_path"]['x'])
+    y_valid = util.dataset_load(params["valid_set_feng_path"]['y'])
 
     return x_valid, y_valid
 
 def load_test_feng(params: dict) -> pd.DataFrame:
-    x_test = util.pickle_load(params["test_set_feng_path"]['x'])
-    y_test = util.pickle_load(params["test_set_feng_path"]['y'])
+    if feng_arrays_available(params):
+        _, _, _, _, x_test, y_test = feng_array_handles(params)
+        return x_test.load(), y_test.load()
+
+    x_test = util.dataset_load(params["test_set_feng_path"]['x'])
+    y_test = util.dataset_load(params["test_set_feng_path"]['y'])
 
     return x_test, y_test
 
@@ -64,6 +116,9 @@ def training_log_template() -> dict:
         "performance" : [],
         "f1_score_avg" : [],
         "data_configurations" : [],
+        "wall_time" : [],
+        "peak_memory_mb" : [],
+        "tuning_log" : [],
     }
 
     # Debug message
@@ -76,35 +131,11 @@ def training_log_updater(current_log: dict, params: dict) -> list:
     # Create copy of current log
     current_log = copy.deepcopy(current_log)
 
-    # Path for training log file
-    log_path = params["training_log_path"]
-
-    # Try to load training log file
-    try:
-        with open(log_path, "r") as file:
-            last_log = json.load(file)
-        file.close()
-
-    # If file not found, create a new one
-    except FileNotFoundError as fe:
-        with open(log_path, "w") as file:
-            file.write("[]")
-        file.close()
-
-        with open(log_path, "r") as file:
-            last_log = json.load(file)
-        file.close()
-    
-    # Add current log to previous log
-    last_log.append(current_log)
-
-    # Save updated log
-    with open(log_path, "w") as file:
-        json.dump(last_log, file)
-        file.close()
+    # Append to training log database, previous entries are never rewritten
+    tracking.append(current_log, params)
 
-    # Return log
-    return last_log
+    # Return appended entry, earlier entries are queried from database when needed
+    return current_log
 
 def create_model_object(params: dict) -> list:
     # Debug message
@@ -114,7 +145,7 @@ def create_model_object(params: dict) -> list:
     lgr = LogisticRegression()
     dct = DecisionTreeClassifier()
     rfc = RandomForestClassifier()
-    knn = KNeighborsClassifier()
+    knn = neighbors.create_classifier(params)
     xgb = XGBClassifier()
 
     # Create list of model
@@ -132,11 +163,89 @@ def create_model_object(params: dict) -> list:
     # Return the list of model
     return list_of_model
 
+def set_random_state(model_object, seed: int) -> None:
+    # Seed every unset random_state, including the ones of wrapped estimators
+    seeds = {name: seed for name, value in model_object.get_params().items()
+             if (name == "random_state" or name.endswith("__random_state")) and value is None}
+    model_object.set_params(**seeds)
+
+def set_n_jobs(model_object, n_jobs: int) -> None:
+    # Limit inner parallelism, e.g. RandomizedSearchCV, when tasks already run in parallel
+    jobs = {name: n_jobs for name in model_object.get_params() if name == "n_jobs" or name.endswith("__n_jobs")}
+    model_object.set_params(**jobs)
+
+def train_eval_task(configuration_model: str, config_data: str, model: dict,
+                    x_train_data: pd.DataFrame, y_train_data: pd.Series,
+                    x_valid: pd.DataFrame, y_valid: pd.Series, seed: int, n_jobs: int = None) -> tuple:
+    # Array handles are opened here, so every worker maps the same file pages
+    x_train_data, y_train_data, x_valid, y_valid = [
+        data.load() if isinstance(data, util.ArrayHandle) else data
+        for data in (x_train_data, y_train_data, x_valid, y_valid)
+    ]
+
+    # Own copy of model, so tasks never share estimator objects
+    model = copy.deepcopy(model)
+    set_random_state(model["model_object"], seed)
+    if n_jobs is not None:
+        set_n_jobs(model["model_object"], n_jobs)
+
+    # Debug message
+    util.print_debug("Training model: {} on configuration data: {}".format(model["model_name"], config_data))
+
+    # Track peak memory of this task
+    util.reset_peak_memory()
+    wall_time = util.time_stamp()
+
+    # Training
+    training_time = util.time_stamp()
+    model["model_object"].fit(x_train_data, y_train_data, **tuning.fit_params(model["model_object"], x_valid, y_valid))
+    training_time = (util.time_stamp() - training_time).total_seconds()
+
+    # Debug message
+    util.print_debug("Evalutaing model: {}".format(model["model_name"]))
+
+    # Evaluation
+    y_predict = model["model_object"].predict(x_valid)
+    performance = classification_report(y_valid, y_predict, output_dict = True)
+
+    wall_time = (util.time_stamp() - wall_time).total_seconds()
+    peak_memory = util.peak_memory_mb()
+
+    # Create UID, task identity keeps it unique when tasks finish at the same time
+    uid = hashlib.md5("{}-{}-{}-{}".format(training_time, configuration_model, config_data, model["model_name"]).encode()).hexdigest()
+
+    # Assign model's UID
+    model["model_uid"] = uid
+
+    # Create training log data
+    model_log = {
+        "model_name" : "{}-{}".format(configuration_model, model["model_name"]),
+        "model_uid" : uid,
+        "training_time" : training_time,
+        "training_date" : util.time_stamp(),
+        "performance" : performance,
+        "f1_score_avg" : performance["macro avg"]["f1-score"],
+        "data_configurations" : config_data,
+        "wall_time" : wall_time,
+        "peak_memory_mb" : peak_memory,
+        "tuning_log" : tuning.candidate_log(model["model_object"])
+    }
+
+    # Debug message
+    util.print_debug("Model {} has been trained for configuration data {}.".format(model["model_name"], config_data))
+
+    return model, model_log
+
 def train_eval(configuration_model: str, params: dict, hyperparams_model: list = None):
-    # Load dataset
-    x_train, y_train, \
-    x_valid, y_valid, \
-    x_test, y_test = load_dataset(params)
+    # Load dataset, as handles when stored memory-mapped so tasks do not receive pickled copies
+    if feng_arrays_available(params):
+        x_train, y_train, \
+        x_valid, y_valid, \
+        x_test, y_test = feng_array_handles(params)
+    else:
+        x_train, y_train, \
+        x_valid, y_valid, \
+        x_test, y_test = load_dataset(params)
 
     # Variabel to store trained models
     list_of_trained_model = dict()
@@ -144,68 +253,38 @@ def train_eval(configuration_model: str, params: dict, hyperparams_model: list =
     # Create log template
     training_log = training_log_template()
 
-    # Training for every data configuration
+    # Every (configuration data, model) pair is an independent task,
+    # with several workers each task gets one core
+    n_jobs = 1 if params["training_workers"] > 1 else None
+    tasks = list()
     for config_data in x_train:
-        # Debug message
-        util.print_debug("Training model based on configuration data: {}".format(config_data))
-
         # Create model objects
         if hyperparams_model == None:
             list_of_model = create_model_object(params)
         else:
-            list_of_model = copy.deepcopy(hyperparams_model)
-
-        # Variabel to store tained model
-        trained_model = list()
+            list_of_model = hyperparams_model
 
-        # Load train data based on its configuration
-        x_train_data = x_train[config_data]
-        y_train_data = y_train[config_data]
-
-        # Train each model by current dataset configuration
         for model in list_of_model:
-            # Debug message
-            util.print_debug("Training model: {}".format(model["model_name"]))
-
-            # Training
-            training_time = util.time_stamp()
-            model["model_object"].fit(x_train_data, y_train_data)
-            training_time = (util.time_stamp() - training_time).total_seconds()
-
-            # Debug message
-            util.print_debug("Evalutaing model: {}".format(model["model_name"]))
-
-            # Evaluation
-            y_predict = model["model_object"].predict(x_valid)
-            performance = classification_report(y_valid, y_predict, output_dict = True)
-
-            # Debug message
-            util.print_debug("Logging: {}".format(model["model_name"]))
-
-            # Create UID
-            uid = hashlib.md5(str(training_time).encode()).hexdigest()
+            tasks.append((configuration_model, config_data, model,
+                          x_train[config_data], y_train[config_data],
+                          x_valid, y_valid, params["training_seed"], n_jobs))
 
-            # Assign model's UID
-            model["model_uid"] = uid
+    # Debug message
+    util.print_debug("Training {} tasks with {} workers.".format(len(tasks), params["training_workers"]))
 
-            # Create training log data
-            training_log["model_name"].append("{}-{}".format(configuration_model, model["model_name"]))
-            training_log["model_uid"].append(uid)
-            training_log["training_time"].append(training_time)
-            training_log["training_date"].append(util.time_stamp())
-            training_log["performance"].append(performance)
-            training_log["f1_score_avg"].append(performance["macro avg"]["f1-score"])
-            training_log["data_configurations"].append(config_data)
+    # Run tasks in process pool, or in this process for a single worker
+    if params["training_workers"] > 1:
+        with ProcessPoolExecutor(max_workers = params["training_workers"]) as executor:
+            results = list(executor.map(train_eval_task, *zip(*tasks)))
+    else:
+        results = [train_eval_task(*task) for task in tasks]
 
-            # Collect current trained model
-            trained_model.append(copy.deepcopy(model))
+    # Collect results in task order, same as sequential training
+    for task, (model, model_log) in zip(tasks, results):
+        list_of_trained_model.setdefault(task[1], list()).append(model)
+        for key in training_log:
+            training_log[key].append(model_log[key])
 
-            # Debug message
-            util.print_debug("Model {} has been trained for configuration data {}.".format(model["model_name"], config_data))
-        
-        # Collect current trained list of model
-        list_of_trained_model[config_data] = copy.deepcopy(trained_model)
-    
     # Debug message
     util.print_debug("All combination models and configuration data has been trained.")
     
@@ -213,12 +292,16 @@ def train_eval(configuration_model: str, params: dict, hyperparams_model: list =
     return list_of_trained_model, training_log
 
 def get_production_model(list_of_model, training_log, params):
-    # Create copy list of model
-    list_of_model = copy.deepcopy(list_of_model)
-    
     # Debug message
     util.print_debug("Choosing model by metrics score.")
 
+    # Track peak memory of selection
+    util.reset_peak_memory()
+
+    # Index of trained models by UID, entries refer to the trained models, nothing is copied
+    model_index = {model_data["model_uid"]: model_data for configuration_data in list_of_model
+                   for model_data in list_of_model[configuration_data]}
+
     # Create required predefined variabel
     curr_production_model = None
     prev_production_model = None
@@ -227,8 +310,8 @@ def get_production_model(list_of_model, training_log, params):
     # Debug message
     util.print_debug("Converting training log type of data from dict to dataframe.")
 
-    # Convert dictionary to pandas for easy operation
-    training_log = pd.DataFrame(copy.deepcopy(training_log))
+    # Convert dictionary to pandas for easy operation, caller's log is not modified
+    training_log = pd.DataFrame(training_log)
 
     # Debug message
     util.print_debug("Trying to load previous production model.")
@@ -239,7 +322,13 @@ def get_production_model(list_of_model, training_log, params):
         util.print_debug("Previous production model loaded.")
 
     except FileNotFoundError as fe:
-        util.print_debug("No previous production model detected, choosing best model only from current trained model.")
+        # Best production model so far, looked up by index of training log, is reloaded from registry
+        best_log = tracking.best(params, "Production-%")
+        if best_log is not None and os.path.exists(registry.version_path(best_log["model_uid"], params)):
+            prev_production_model = util.pickle_load(registry.version_path(best_log["model_uid"], params))
+            util.print_debug("Production model file missing, model {} loaded from registry.".format(best_log["model_uid"]))
+        else:
+            util.print_debug("No previous production model detected, choosing best model only from current trained model.")
 
     # If previous production model detected:
     if prev_production_model != None:
@@ -263,8 +352,9 @@ def get_production_model(list_of_model, training_log, params):
             # Debug message
             util.print_debug("Reassesing previous model performance using current validation data.")
 
-            # Re-predict previous production model to provide valid metrics compared to other current models
-            y_pred = prev_production_model["model_data"]["model_object"].predict(x_valid)
+            # Re-predict previous production model to provide valid metrics compared to other current models,
+            # prediction is reused while model and validation set stay the same
+            y_pred = cached_valid_predict(prev_production_model["model_data"], x_valid, params)
 
             # Re-asses prediction result
             eval_res = classification_report(y_valid, y_pred, output_dict = True)
@@ -285,8 +375,8 @@ def get_production_model(list_of_model, training_log, params):
             # Added previous production model log to current logs to compere who has the greatest f1 score
             training_log = pd.concat([training_log, pd.DataFrame([prev_production_model["model_log"]])])
 
-            # Added previous production model to current list of models to choose from if it has the greatest f1 score
-            list_of_model["prev_production_model"] = [copy.deepcopy(prev_production_model["model_data"])]
+            # Added previous production model to models to choose from if it has the greatest f1 score
+            model_index[prev_production_model["model_data"]["model_uid"]] = prev_production_model["model_data"]
         else:
             # To indicate that we are not using previous production model
             prev_production_model = None
@@ -303,31 +393,76 @@ def get_production_model(list_of_model, training_log, params):
     # Debug message
     util.print_debug("Searching model data based on sorted training log.")
 
-    # Get model object with greatest f1 score macro avg by using UID
-    for configuration_data in list_of_model:
-        for model_data in list_of_model[configuration_data]:
-            if model_data["model_uid"] == best_model_log["model_uid"]:
-                curr_production_model = dict()
-                curr_production_model["model_data"] = copy.deepcopy(model_data)
-                curr_production_model["model_log"] = copy.deepcopy(best_model_log.to_dict())
-                curr_production_model["model_log"]["model_name"] = "Production-{}".format(curr_production_model["model_data"]["model_name"])
-                curr_production_model["model_log"]["training_date"] = str(curr_production_model["model_log"]["training_date"])
-                production_model_log = training_log_updater(curr_production_model["model_log"], params)
-                break
-    
     # In case UID not found
-    if curr_production_model == None:
+    if best_model_log["model_uid"] not in model_index:
         raise RuntimeError("The best model not found in your list of model.")
+
+    # Get model with greatest f1 score macro avg by using UID, model object is shared with trained models
+    curr_production_model = dict()
+    curr_production_model["model_data"] = dict(model_index[best_model_log["model_uid"]])
+    curr_production_model["model_log"] = best_model_log.dropna().to_dict()
+    curr_production_model["model_log"]["model_name"] = "Production-{}".format(curr_production_model["model_data"]["model_name"])
+    curr_production_model["model_log"]["training_date"] = str(curr_production_model["model_log"]["training_date"])
     
     # Debug message
     util.print_debug("Model chosen.")
 
-    # Dump chosen production model
-    util.pickle_dump(curr_production_model, params["production_model_path"])
+    # Peak memory of selection, logged with chosen model
+    curr_production_model["model_log"]["selection_peak_memory_mb"] = util.peak_memory_mb()
+    util.print_debug("Selection peak memory: {:.1f} MB.".format(curr_production_model["model_log"]["selection_peak_memory_mb"]))
+
+    # Log chosen production model
+    production_model_log = training_log_updater(curr_production_model["model_log"], params)
+
+    # Dump chosen production model, API picks it up from registry and production path.
+    # Artifact of each pickle is in place before the pickle itself, so a reload never misses it
+    model_uid = curr_production_model["model_data"]["model_uid"]
+    util.pickle_dump(curr_production_model, params["production_model_path"],
+                     lambda tmp_path: export_production_artifact(curr_production_model, params, params["production_model_path"], tmp_path))
+    registry.register_model(curr_production_model, params,
+                            lambda tmp_path: export_production_artifact(curr_production_model, params, registry.version_path(model_uid, params), tmp_path))
     
-    # Return current chosen production model, log of production models and current training log
+    # Return current chosen production model, its training log entry and current training log
     return curr_production_model, production_model_log, training_log
 
+def cached_valid_predict(model_data: dict, x_valid: pd.DataFrame, params: dict) -> np.ndarray:
+    # Predictions are keyed by model UID and content hash of validation features
+    digest = hashlib.sha256(json.dumps([str(col) for col in x_valid.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(x_valid, index = True).to_numpy().tobytes())
+    cache_path = os.path.join(params["validation_cache_path"], "{}-{}.npy".format(model_data["model_uid"], digest.hexdigest()[:16]))
+
+    try:
+        y_pred = np.load(cache_path, allow_pickle = False)
+        util.print_debug("Validation predictions of model {} loaded from cache.".format(model_data["model_uid"]))
+        return y_pred
+    except (FileNotFoundError, ValueError):
+        pass
+
+    y_pred = np.asarray(model_data["model_object"].predict(x_valid))
+
+    # Written then renamed, so concurrent runs never read half written file
+    os.makedirs(params["validation_cache_path"], exist_ok = True)
+    tmp_path = f"{cache_path}.tmp.npy"
+    np.save(tmp_path, y_pred, allow_pickle = False)
+    os.replace(tmp_path, cache_path)
+    return y_pred
+
+def export_production_artifact(production_model: dict, params: dict, model_path: str, staged_path: str) -> None:
+    # Compact arrays of production model and encoder layout, for serving without sklearn and xgboost.
+    # Digest is of the pickle staged to be renamed to model_path
+    ohe_encoders = {col: util.pickle_load(params[f"ohe_{col}_path"]) for col in ["Department", "JobRole", "OverTime"]}
+    int_columns = [col for col in params["predictor_columns"] if col in params["int64_columns"]]
+    model_uid = production_model["model_data"]["model_uid"]
+
+    exported = artifact.export_artifact(production_model["model_data"]["model_object"], model_uid,
+                                        ohe_encoders, int_columns, artifact.artifact_path(model_path),
+                                        artifact.file_digest(staged_path))
+
+    if exported:
+        util.print_debug("Production model artifact exported.")
+    else:
+        util.print_debug("No compact artifact for {}, serving uses the pickle.".format(production_model["model_data"]["model_name"]))
+
 def create_dist_params(model_name: str) -> dict:
     # Define models paramteres
     dist_params_xgb = {
@@ -338,10 +473,13 @@ def create_dist_params(model_name: str) -> dict:
         "min_samples_split" : [2, 4, 6, 10, 15, 20, 25],
         "min_samples_leaf" : [2, 4, 6, 10, 15, 20, 25]
     }
+    # Search algorithm only changes speed, it comes from neighbors backend in config
     dist_params_knn = {
-        "algorithm" : ["ball_tree", "kd_tree", "brute"],
         "n_neighbors" : [2, 3, 4, 5, 6, 10, 15, 20, 25],
-        "leaf_size" : [2, 3, 4, 5, 6, 10, 15, 20, 25],
+    }
+    dist_params_ivf = {
+        "n_neighbors" : [2, 3, 4, 5, 6, 10, 15, 20, 25],
+        "n_probe" : [2, 4, 8, 16, 32],
     }
     dist_params_lgr = {
         "penalty" : ["l1", "l2", "elasticnet", "none"],
@@ -361,6 +499,7 @@ def create_dist_params(model_name: str) -> dict:
         "XGBClassifier": dist_params_xgb,
         "DecisionTreeClassifier": dist_params_dct,
         "KNeighborsClassifier": dist_params_knn,
+        "IVFKNeighborsClassifier": dist_params_ivf,
         "LogisticRegression": dist_params_lgr,
         "RandomForestClassifier": dist_params_rfc
     }
@@ -368,18 +507,16 @@ def create_dist_params(model_name: str) -> dict:
     # Return distribution of model parameters
     return dist_params[model_name]
 
-def hyper_params_tuning(model: dict) -> list:
-    # Create copy of current best baseline model
-    model = copy.deepcopy(model)
-
+def hyper_params_tuning(model: dict, params: dict) -> list:
     # Create model's parameter distribution
     dist_params = create_dist_params(model["model_data"]["model_name"])
 
-    # Create model object
-    model_rsc = RandomizedSearchCV(model["model_data"]["model_object"], dist_params, n_jobs = -1)
+    # Create search object of configured tuner, sized to time budget by baseline training time
+    model_tuner = tuning.create_tuner(model["model_data"]["model_object"], dist_params, params,
+                                      model["model_log"].get("training_time"))
     model_data = {
         "model_name": model["model_data"]["model_name"],
-        "model_object": model_rsc,
+        "model_object": model_tuner,
         "model_uid": ""
     }
     
@@ -408,7 +545,7 @@ if __name__ == "__main__":
     list_of_trained_model, training_log = train_eval(
         "Hyperparams_Tuning",
         params,
-        hyper_params_tuning(model)
+        hyper_params_tuning(model, params)
     )
 
     # 5. Choost the best model for production
@@ -0,0 +1,165 @@
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.utils.validation import check_is_fitted, validate_data
+
+# Exact backends are sklearn NearestNeighbors algorithms, ivf is the approximate index below
+exact_backends = ["auto", "brute", "kd_tree", "ball_tree"]
+
+def squared_distances(x: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    # Pairwise squared euclidean distances, clipped at zero against rounding
+    distances = (x ** 2).sum(axis = 1)[:, None] - 2 * x @ centers.T + (centers ** 2).sum(axis = 1)[None, :]
+    return np.maximum(distances, 0)
+
+class IVFIndex:
+    """
+    Approximate nearest neighbor index in plain NumPy. Rows are split into n_lists cells by
+    k-means, a query only measures rows of the n_probe cells with nearest centers. Queries
+    that find fewer than n_neighbors candidates fall back to exact search.
+    """
+    # Centers are learned on a sample of this many rows per cell
+    sample_per_list = 64
+
+    def __init__(self, n_neighbors: int = 5, n_lists: int = None, n_probe: int = 8, n_iter: int = 10,
+                 random_state: int = None, chunk_rows: int = 10000):
+        self.n_neighbors = n_neighbors
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.random_state = random_state
+        self.chunk_rows = chunk_rows
+
+    def assign(self, x: np.ndarray) -> np.ndarray:
+        # Nearest center of every row, in chunks so distance matrix stays small. Norm of the
+        # row is the same for every center and is left out
+        center_norms = (self.centers ** 2).sum(axis = 1)
+        cell = np.empty(len(x), dtype = np.intp)
+        for start in range(0, len(x), self.chunk_rows):
+            distances = x[start:start + self.chunk_rows] @ self.centers.T
+            distances *= -2
+            distances += center_norms
+            cell[start:start + self.chunk_rows] = distances.argmin(axis = 1)
+        return cell
+
+    def fit(self, x, y = None):
+        x = np.asarray(x, dtype = np.float64)
+        n_lists = min(self.n_lists or max(1, int(np.sqrt(len(x)))), len(x))
+
+        # Lloyd iterations from random rows, empty cells keep their center
+        rng = np.random.default_rng(self.random_state)
+        sample = x[rng.choice(len(x), min(len(x), n_lists * self.sample_per_list), replace = False)]
+        self.centers = sample[:n_lists].copy()
+        for _ in range(self.n_iter):
+            cell = self.assign(sample)
+            counts = np.bincount(cell, minlength = n_lists)
+            sums = np.stack([np.bincount(cell, weights = sample[:, j], minlength = n_lists) for j in range(x.shape[1])], axis = 1)
+            filled = counts > 0
+            self.centers[filled] = sums[filled] / counts[filled, None]
+
+        # Rows stored cell by cell, order maps them back to row numbers of x
+        cell = self.assign(x)
+        self.order = np.argsort(cell, kind = "stable")
+        self.bounds = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength = n_lists))])
+        self.x = x[self.order]
+        return self
+
+    def search(self, query: np.ndarray, n_neighbors: int, n_probe: int) -> tuple:
+        # Nearest rows among probed cells, position in self.x, inf where a query has too few candidates
+        probe = np.argpartition(squared_distances(query, self.centers), n_probe - 1, axis = 1)[:, :n_probe]
+        distances = np.full((len(query), n_neighbors), np.inf)
+        positions = np.full((len(query), n_neighbors), -1, dtype = np.int64)
+
+        # Queries grouped by probed cell, each cell measured with one matrix product
+        pairs = np.argsort(probe.ravel(), kind = "stable")
+        cells = probe.ravel()[pairs]
+        queries = pairs // n_probe
+        splits = np.flatnonzero(np.diff(cells)) + 1
+        for cell, rows in zip(cells[np.concatenate([[0], splits])], np.split(queries, splits)):
+            start, end = self.bounds[cell], self.bounds[cell + 1]
+            if start == end:
+                continue
+            merged_distances = np.concatenate([distances[rows], squared_distances(query[rows], self.x[start:end])], axis = 1)
+            merged_positions = np.concatenate([positions[rows], np.broadcast_to(np.arange(start, end), (len(rows), end - start))], axis = 1)
+            nearest = np.argpartition(merged_distances, n_neighbors - 1, axis = 1)[:, :n_neighbors]
+            distances[rows] = np.take_along_axis(merged_distances, nearest, axis = 1)
+            positions[rows] = np.take_along_axis(merged_positions, nearest, axis = 1)
+        return distances, positions
+
+    def kneighbors(self, x, n_neighbors: int = None, return_distance: bool = True):
+        # Same interface as sklearn NearestNeighbors given query rows, neighbors sorted by distance
+        n_neighbors = n_neighbors or self.n_neighbors
+        x = np.asarray(x, dtype = np.float64)
+        n_probe = min(self.n_probe, len(self.centers))
+
+        distances = np.empty((len(x), n_neighbors))
+        indices = np.empty((len(x), n_neighbors), dtype = np.int64)
+        for start in range(0, len(x), self.chunk_rows):
+            query = x[start:start + self.chunk_rows]
+            chunk_distances, positions = self.search(query, n_neighbors, n_probe)
+
+            # Too few candidates in probed cells, exact search over every row
+            short = np.isinf(chunk_distances[:, -1])
+            if short.any():
+                chunk_distances[short], positions[short] = self.search(query[short], n_neighbors, len(self.centers))
+
+            order = np.argsort(chunk_distances, axis = 1, kind = "stable")
+            distances[start:start + len(query)] = np.take_along_axis(chunk_distances, order, axis = 1)
+            indices[start:start + len(query)] = self.order[np.take_along_axis(positions, order, axis = 1)]
+
+        if return_distance:
+            return np.sqrt(distances), indices
+        return indices
+
+class IVFKNeighborsClassifier(ClassifierMixin, BaseEstimator):
+    """
+    KNeighborsClassifier with uniform weights on top of IVFIndex, for training sets where
+    exact search is too slow to serve.
+    """
+    def __init__(self, n_neighbors: int = 5, n_lists: int = None, n_probe: int = 8, random_state: int = None):
+        self.n_neighbors = n_neighbors
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        X, y = validate_data(self, X, y)
+        self.classes_, self.y_ = np.unique(y, return_inverse = True)
+        self.index_ = IVFIndex(self.n_neighbors, self.n_lists, self.n_probe, random_state = self.random_state).fit(X)
+        return self
+
+    def predict_proba(self, X) -> np.ndarray:
+        check_is_fitted(self)
+        X = validate_data(self, X, reset = False)
+        labels = self.y_[self.index_.kneighbors(X, return_distance = False)]
+
+        # Share of neighbors in every class
+        proba = np.zeros((len(X), len(self.classes_)))
+        for i in range(len(self.classes_)):
+            proba[:, i] = (labels == i).mean(axis = 1)
+        return proba
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_[self.predict_proba(X).argmax(axis = 1)]
+
+def create_index(params: dict, n_neighbors: int = 5):
+    # Neighbor search of neighbors_backend in config, fitted and queried like NearestNeighbors
+    backend = params.get("neighbors_backend", "auto")
+    if backend in exact_backends:
+        from sklearn.neighbors import NearestNeighbors
+        return NearestNeighbors(n_neighbors = n_neighbors, algorithm = backend, leaf_size = params.get("neighbors_leaf_size", 30))
+    if backend == "ivf":
+        return IVFIndex(n_neighbors, params.get("ivf_n_lists"), params.get("ivf_n_probe", 8), random_state = params.get("training_seed"))
+    raise RuntimeError("Unknown neighbors backend {}.".format(backend))
+
+def create_classifier(params: dict):
+    # KNN candidate of modeling on the configured neighbors backend
+    backend = params.get("neighbors_backend", "auto")
+    if backend in exact_backends:
+        from sklearn.neighbors import KNeighborsClassifier
+        return KNeighborsClassifier(algorithm = backend, leaf_size = params.get("neighbors_leaf_size", 30))
+    if backend == "ivf":
+        return IVFKNeighborsClassifier(n_lists = params.get("ivf_n_lists"), n_probe = params.get("ivf_n_probe", 8))
+    raise RuntimeError("Unknown neighbors backend {}.".format(backend))
+
+def recall(distances: np.ndarray, exact_distances: np.ndarray) -> float:
+    # Share of returned neighbors as near as the k-th exact neighbor, so rows tied in distance count as found
+    return float((distances <= exact_distances[:, -1:] * (1 + 1e-9)).mean())
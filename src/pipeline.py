@@ -0,0 +1,140 @@
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import util as util
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Every stage declares what its result depends on: config keys, input files and code,
+# and which files it produces. Keys may use wildcards, e.g. *_range.
+stages = [
+    {
+        "name": "data_pipeline",
+        "code": ["data_pipeline.py", "util.py"],
+        "config": ["raw_dataset_path", "int64_columns", "object_columns", "predictor_columns", "target_column", "*_range",
+                   "raw_dataset_collected_path", "train_set_path", "valid_set_path", "test_set_path"],
+        "inputs": lambda params: [params["raw_dataset_path"]],
+        "outputs": lambda params: [params["raw_dataset_collected_path"]] + [params[f"{name}_set_path"][xy]
+                                   for name in ["train", "valid", "test"] for xy in ["x", "y"]]
+    },
+    {
+        "name": "preprocessing",
+        "code": ["preprocessing.py", "neighbors.py", "util.py"],
+        "config": ["predictor_columns", "missing_value_handling", "Attrition_range", "ohe_*_path", "le_encoder_path",
+                   "train_set_feng_path", "valid_set_feng_path", "test_set_feng_path", "feng_array_path",
+                   "resampling_path", "smote_chunk_rows", "neighbors_*", "ivf_*", "training_seed"],
+        "inputs": lambda params: [params[f"{name}_set_path"][xy] for name in ["train", "valid", "test"] for xy in ["x", "y"]],
+        "outputs": lambda params: [params[f"{name}_set_feng_path"][xy] for name in ["train", "valid", "test"] for xy in ["x", "y"]] +
+                                  [params[f"ohe_{col}_path"] for col in ["Department", "JobRole", "OverTime"]] +
+                                  [params["le_encoder_path"], params["feng_array_path"], params["resampling_path"]]
+    },
+    {
+        "name": "modeling",
+        "code": ["modeling.py", "registry.py", "artifact.py", "tuning.py", "tracking.py", "neighbors.py", "util.py"],
+        "config": ["training_seed", "use_memmap", "production_model_path", "training_log_path", "training_log_db_path", "model_registry_path", "validation_cache_path",
+                   "tuning_*", "xgb_early_stopping_rounds", "neighbors_*", "ivf_*"],
+        "inputs": lambda params: [params[f"{name}_set_feng_path"][xy] for name in ["train", "valid", "test"] for xy in ["x", "y"]] +
+                                 [params["feng_array_path"], params["resampling_path"]],
+        "outputs": lambda params: [params["production_model_path"]]
+    }
+]
+
+def hash_path(path: str, digest) -> None:
+    # Content of file, or of every file in directory in name order
+    if os.path.isdir(path):
+        for root, dirs, file_names in os.walk(path):
+            dirs.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(root, file_name)
+                digest.update(os.path.relpath(file_path, path).encode())
+                hash_path(file_path, digest)
+    elif os.path.exists(path):
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+    else:
+        digest.update(b"<missing>")
+
+def hash_paths(paths: list) -> str:
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode())
+        hash_path(path, digest)
+    return digest.hexdigest()
+
+def stage_config(stage: dict, params: dict) -> dict:
+    return {key: params[key] for key in sorted(params) if any(fnmatch.fnmatch(key, pattern) for pattern in stage["config"])}
+
+def stage_key(stage: dict, params: dict) -> str:
+    # Inputs content, relevant config and stage code together decide whether stage must rerun
+    digest = hashlib.sha256()
+    digest.update(hash_paths(stage["inputs"](params)).encode())
+    digest.update(json.dumps(stage_config(stage, params), sort_keys = True).encode())
+    digest.update(hash_paths([os.path.join(src_dir, file_name) for file_name in stage["code"]]).encode())
+    return digest.hexdigest()
+
+def load_manifest(params: dict) -> dict:
+    try:
+        with open(params["pipeline_manifest_path"], "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return dict()
+
+def dump_manifest(manifest: dict, params: dict) -> None:
+    tmp_path = f"{params['pipeline_manifest_path']}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(manifest, file, indent = 2)
+    os.replace(tmp_path, params["pipeline_manifest_path"])
+
+def run_pipeline(params: dict, force: list = []) -> list:
+    manifest = load_manifest(params)
+    report = list()
+
+    for stage in stages:
+        key = stage_key(stage, params)
+        entry = manifest.get(stage["name"])
+
+        # Hit when same key was run before and its outputs are still the ones it wrote
+        hit = stage["name"] not in force and entry is not None and entry["key"] == key and \
+            entry["outputs"] == hash_paths(stage["outputs"](params))
+
+        if hit:
+            util.print_debug("Stage {} is up to date, skipped.".format(stage["name"]))
+            report.append({"stage": stage["name"], "status": "hit", "duration": 0, "saved": entry["duration"]})
+            continue
+
+        # Run stage script as it is run by hand
+        util.print_debug("Running stage {}.".format(stage["name"]))
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(src_dir, f"{stage['name']}.py")], check = True)
+        duration = time.perf_counter() - start
+
+        manifest[stage["name"]] = {"key": key,
+                                   "outputs": hash_paths(stage["outputs"](params)),
+                                   "duration": duration,
+                                   "date": str(util.time_stamp())}
+        dump_manifest(manifest, params)
+        report.append({"stage": stage["name"], "status": "run", "duration": duration, "saved": 0})
+
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Run data pipeline, preprocessing and modeling, skipping up to date stages")
+    parser.add_argument("--force", nargs = "*", default = [], choices = [stage["name"] for stage in stages],
+                        help = "Stages to run even when up to date")
+    args = parser.parse_args()
+
+    params = util.load_config()
+    report = run_pipeline(params, args.force)
+
+    print(f"{'stage':<15} {'status':<7} {'time s':>8} {'saved s':>8}")
+    for row in report:
+        print(f"{row['stage']:<15} {row['status']:<7} {row['duration']:>8.1f} {row['saved']:>8.1f}")
+    print(f"Cache hits: {sum(row['status'] == 'hit' for row in report)}/{len(report)}, "
+          f"time saved: {sum(row['saved'] for row in report):.1f} s")
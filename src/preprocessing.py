@@ -1,22 +1,22 @@
 import pandas as pd
 import numpy as np
-import seaborn as sns
+import json
+import os
 import util as util
-from imblearn.under_sampling import RandomUnderSampler
-from imblearn.over_sampling import RandomOverSampler, SMOTE
-from sklearn.preprocessing import LabelEncoder
-from sklearn.preprocessing import OneHotEncoder
+
+# sklearn and imblearn are imported by fitting functions only, serving imports this
+# module for FeatureEncoder and should not pay for them
 
 def load_dataset(config_data: dict) -> pd.DataFrame:
     # Load every set of data
-    x_train = util.pickle_load(config_data["train_set_path"]['x'])
-    y_train = util.pickle_load(config_data["train_set_path"]['y'])
+    x_train = util.dataset_load(config_data["train_set_path"]['x'], columns = config_data["predictor_columns"])
+    y_train = util.dataset_load(config_data["train_set_path"]['y'])
 
-    x_valid = util.pickle_load(config_data["valid_set_path"]['x'])
-    y_valid = util.pickle_load(config_data["valid_set_path"]['y'])
+    x_valid = util.dataset_load(config_data["valid_set_path"]['x'], columns = config_data["predictor_columns"])
+    y_valid = util.dataset_load(config_data["valid_set_path"]['y'])
 
-    x_test = util.pickle_load(config_data["test_set_path"]['x'])
-    y_test = util.pickle_load(config_data["test_set_path"]['y'])
+    x_test = util.dataset_load(config_data["test_set_path"]['x'], columns = config_data["predictor_columns"])
+    y_test = util.dataset_load(config_data["test_set_path"]['y'])
 
     # Concatenate x and y each set
     train_set = pd.concat([x_train, y_train], axis = 1)
@@ -27,14 +27,18 @@ def load_dataset(config_data: dict) -> pd.DataFrame:
     return train_set, valid_set, test_set
 
 def ohe_fit(categorical_attribute, ohe_model_path):
+    from sklearn.preprocessing import OneHotEncoder
     ohe = OneHotEncoder(sparse_output=False)
     ohe.fit(np.array(categorical_attribute).reshape(-1, 1))
     util.pickle_dump(ohe, ohe_model_path)
     return ohe
 
-def ohe_transform(set_data: pd.DataFrame, transformed_column: str, ohe_path: str) -> pd.DataFrame:
+def ohe_transform(set_data: pd.DataFrame, transformed_column: str, ohe_path: str, ohe: "OneHotEncoder" = None) -> pd.DataFrame:
     set_data = set_data.copy()
-    ohe = util.pickle_load(ohe_path)
+
+    # Load encoder from disk only when caller does not hold a fitted one
+    if ohe is None:
+        ohe = util.pickle_load(ohe_path)
 
     features = ohe.transform(np.array(set_data[transformed_column].to_list()).reshape(-1, 1))
     features = pd.DataFrame(features.tolist(), columns=ohe.get_feature_names_out([transformed_column]))
@@ -48,36 +52,161 @@ def ohe_transform(set_data: pd.DataFrame, transformed_column: str, ohe_path: str
 
     return set_data
 
-def rus_fit_resample(set_data: pd.DataFrame) -> pd.DataFrame:
-    set_data = set_data.copy()
-    rus = RandomUnderSampler(random_state = 42)
-    x_rus, y_rus = rus.fit_resample(set_data.drop("Attrition", axis = 1), set_data['Attrition'])
-    set_data_rus = pd.concat([x_rus, y_rus], axis = 1)
-    return set_data_rus
+class FeatureEncoder:
+    """
+    Compiled encoder for prediction input. One hot and int columns are written straight
+    into a preallocated float32 matrix with the same column layout as the trained model.
+    """
+    # Batch size below which per value lookup beats vectorized lookup
+    small_batch = 64
 
-def ros_fit_resample(set_data: pd.DataFrame) -> pd.DataFrame:
-    set_data = set_data.copy()
-    ros = RandomOverSampler(random_state = 11)
-    x_ros, y_ros = ros.fit_resample(set_data.drop("Attrition", axis = 1), set_data['Attrition'])
-    set_data_ros = pd.concat([x_ros, y_ros], axis = 1)
-    return set_data_ros
+    def __init__(self, ohe_encoders: dict, int_columns: list, feature_names: list = None):
+        # Categories of fitted encoders, or plain category lists as stored in model artifact
+        categories = {col: np.asarray(getattr(ohe, "categories_", [ohe])[0], dtype = object) for col, ohe in ohe_encoders.items()}
 
-def sm_fit_resample(set_data: pd.DataFrame) -> pd.DataFrame:
-    set_data = set_data.copy()
-    sm = SMOTE(random_state = 112)
-    x_sm, y_sm = sm.fit_resample(set_data.drop("Attrition", axis = 1), set_data['Attrition'])
-    set_data_sm = pd.concat([x_sm, y_sm], axis = 1)
-    return set_data_sm
+        # Default layout follows ohe_transform: encoded columns are prepended, last encoded comes first
+        if feature_names is None:
+            feature_names = list()
+            for col in reversed(list(categories)):
+                feature_names += [f"{col}_{category}" for category in categories[col]]
+            feature_names += list(int_columns)
+
+        self.feature_names = [str(col_name) for col_name in feature_names]
+        position = {col_name: i for i, col_name in enumerate(self.feature_names)}
+
+        # Output position of each category, per categorical column, named as OneHotEncoder names them
+        self.category_index = dict()
+        self.category_positions = dict()
+        for col, col_categories in categories.items():
+            positions = [position[f"{col}_{category}"] for category in col_categories]
+            self.category_index[col] = pd.Index(col_categories)
+            self.category_positions[col] = dict(zip(col_categories.tolist(), positions))
+
+        # Output position of each int column
+        self.int_positions = {col: position[col] for col in int_columns}
+
+    def column(self, data, col: str) -> np.ndarray:
+        # Single record
+        if isinstance(data, dict):
+            return np.array([data[col]])
+
+        # List of records
+        if isinstance(data, list):
+            return np.array([record[col] for record in data])
+
+        # Record array or dataframe
+        return np.asarray(data[col])
+
+    def transform(self, data) -> np.ndarray:
+        n_rows = 1 if isinstance(data, dict) else len(data)
+        matrix = np.zeros((n_rows, len(self.feature_names)), dtype = np.float32)
+
+        for col, pos in self.int_positions.items():
+            matrix[:, pos] = self.column(data, col)
+
+        for col, category_positions in self.category_positions.items():
+            values = self.column(data, col)
+
+            # Small batch: plain dict lookup, large batch: vectorized index lookup
+            try:
+                if n_rows <= self.small_batch:
+                    positions = [category_positions[value] for value in values]
+                else:
+                    codes = self.category_index[col].get_indexer(values)
+                    if (codes < 0).any():
+                        raise KeyError(values[codes < 0][0])
+                    positions = np.fromiter(category_positions.values(), dtype = np.intp)[codes]
+            except KeyError as ke:
+                raise ValueError(f"Found unknown category {ke} in column {col}")
+
+            matrix[np.arange(n_rows), positions] = 1
+
+        return matrix
+
+    def transform_frame(self, data) -> pd.DataFrame:
+        # Keep feature names for model and explainer
+        return pd.DataFrame(self.transform(data), columns = self.feature_names, copy = False)
+
+def sampler_plan(sampler, y: np.ndarray) -> dict:
+    # Random samplers only pick rows, so they run on row numbers instead of the features
+    sampler.fit_resample(np.arange(len(y)).reshape(-1, 1), y)
+    return {"index": sampler.sample_indices_.astype(np.int64), "origin": np.empty(0, dtype = np.int64),
+            "neighbor": np.empty(0, dtype = np.int64), "step": np.empty(0), "label": np.empty(0, dtype = y.dtype)}
 
-def le_fit(data_tobe_fitted: dict, le_path: str) -> LabelEncoder:
+def rus_plan(y: np.ndarray) -> dict:
+    from imblearn.under_sampling import RandomUnderSampler
+    return sampler_plan(RandomUnderSampler(random_state = 42), y)
+
+def ros_plan(y: np.ndarray) -> dict:
+    from imblearn.over_sampling import RandomOverSampler
+    return sampler_plan(RandomOverSampler(random_state = 11), y)
+
+def class_neighbors(x_class: np.ndarray, k_neighbors: int, config_data: dict) -> np.ndarray:
+    # k nearest neighbors within minority class on configured backend, queried in chunks
+    # so distances of one chunk live at a time
+    import neighbors as neighbors
+    chunk_rows = config_data["smote_chunk_rows"]
+    nn = neighbors.create_index(config_data, k_neighbors + 1).fit(x_class)
+    return np.concatenate([nn.kneighbors(x_class[start:start + chunk_rows], return_distance = False)[:, 1:]
+                           for start in range(0, len(x_class), chunk_rows)])
+
+def smote_plan(x: np.ndarray, y: np.ndarray, config_data: dict, k_neighbors: int = 5, random_state: int = 112) -> dict:
+    """
+    Synthetic rows of SMOTE as (origin, neighbor, step) over rows of x, drawn with the same
+    random numbers as imblearn SMOTE, so with an exact neighbors backend materialized rows
+    equal its output.
+    """
+    from imblearn.utils import check_sampling_strategy
+    from sklearn.utils import check_random_state
+
+    origin, neighbor, step, label = list(), list(), list(), list()
+    for class_sample, n_samples in check_sampling_strategy("auto", y, "over-sampling").items():
+        if n_samples == 0:
+            continue
+        target = np.flatnonzero(y == class_sample)
+        nns = class_neighbors(x[target], k_neighbors, config_data)
+
+        # Fresh generator per class, as imblearn seeds it
+        rng = check_random_state(random_state)
+        samples_indices = rng.randint(low = 0, high = nns.size, size = n_samples)
+        steps = rng.uniform(size = n_samples)
+        rows = samples_indices // nns.shape[1]
+        cols = samples_indices % nns.shape[1]
+
+        origin.append(target[rows])
+        neighbor.append(target[nns[rows, cols]])
+        step.append(steps)
+        label.append(np.full(n_samples, class_sample, dtype = y.dtype))
+
+    return {"index": np.arange(len(y), dtype = np.int64), "origin": np.concatenate(origin).astype(np.int64),
+            "neighbor": np.concatenate(neighbor).astype(np.int64), "step": np.concatenate(step), "label": np.concatenate(label)}
+
+def resampling_dump(plans: dict, config_data: dict) -> None:
+    # One plan file per resampled configuration, base training set needs none
+    resampling_path = config_data["resampling_path"]
+    os.makedirs(resampling_path, exist_ok = True)
+
+    configurations = dict()
+    for configuration, plan in plans.items():
+        configurations[configuration] = None
+        if plan is not None:
+            configurations[configuration] = configuration.lower().replace(" ", "_") + ".npz"
+            util.plan_dump(plan, os.path.join(resampling_path, configurations[configuration]))
+
+    with open(os.path.join(resampling_path, "meta.json"), "w") as file:
+        json.dump({"configurations": configurations}, file)
+
+def le_fit(data_tobe_fitted: dict, le_path: str) -> "LabelEncoder":
+    from sklearn.preprocessing import LabelEncoder
     le_encoder = LabelEncoder()
     le_encoder.fit(data_tobe_fitted)
     util.pickle_dump(le_encoder, le_path)
     return le_encoder
 
-def le_transform(label_data: pd.Series, config_data: dict) -> pd.Series:
+def le_transform(label_data: pd.Series, config_data: dict, le_encoder: "LabelEncoder" = None) -> pd.Series:
     label_data = label_data.copy()
-    le_encoder = util.pickle_load(config_data["le_encoder_path"])
+    if le_encoder is None:
+        le_encoder = util.pickle_load(config_data["le_encoder_path"])
 
     # If categories both label data and trained le matched
     if len(set(label_data.unique()) - set(le_encoder.classes_) | set(le_encoder.classes_) - set(label_data.unique())) == 0:
@@ -87,6 +216,26 @@ def le_transform(label_data: pd.Series, config_data: dict) -> pd.Series:
 
     return label_data
 
+def feng_array_dump(x_train: pd.DataFrame, y_train: pd.Series, x_valid: pd.DataFrame, y_valid: pd.Series,
+                    x_test: pd.DataFrame, y_test: pd.Series, config_data: dict) -> None:
+    # Contiguous float64 features and int8 labels, readable memory-mapped by training workers.
+    # Same dtype as the Arrow files, so both loading paths train on identical values
+    array_path = config_data["feng_array_path"]
+    os.makedirs(array_path, exist_ok = True)
+
+    # Training set is written once, resampled sets are built from it with resampling plans
+    util.array_dump(x_train, os.path.join(array_path, "x_train.npy"), np.float64)
+    util.array_dump(y_train, os.path.join(array_path, "y_train.npy"), np.int8)
+    util.array_dump(x_valid, os.path.join(array_path, "x_valid.npy"), np.float64)
+    util.array_dump(y_valid, os.path.join(array_path, "y_valid.npy"), np.int8)
+    util.array_dump(x_test, os.path.join(array_path, "x_test.npy"), np.float64)
+    util.array_dump(y_test, os.path.join(array_path, "y_test.npy"), np.int8)
+
+    # Column names and integer columns to rebuild frames on load
+    with open(os.path.join(array_path, "meta.json"), "w") as file:
+        json.dump({"columns": x_valid.columns.to_list(), "target": y_valid.name,
+                   "integer": [pd.api.types.is_integer_dtype(dtype) for dtype in x_train.dtypes]}, file)
+
 if __name__ == "__main__":
     config_data = util.load_config()
     train_set, valid_set, test_set = load_dataset(config_data)
@@ -96,50 +245,45 @@ if __name__ == "__main__":
     valid_set.fillna(value=impute_values, inplace=True)
     test_set.fillna(value=impute_values, inplace=True)
 
-    ohe_Department = ohe_fit(config_data['Department_range'], config_data['ohe_Department_path'])
-    ohe_JobRole = ohe_fit(config_data['JobRole_range'], config_data['ohe_JobRole_path'])
-    ohe_OverTime = ohe_fit(config_data['OverTime_range'], config_data['ohe_OverTime_path'])
-
+    ohe_encoders = dict()
     for col in ['Department', 'JobRole', 'OverTime']:
-        train_set = ohe_transform(train_set, col, config_data[f"ohe_{col}_path"])
-        valid_set = ohe_transform(valid_set, col, config_data[f"ohe_{col}_path"])
-        test_set = ohe_transform(test_set, col, config_data[f"ohe_{col}_path"])
+        ohe_encoders[col] = ohe_fit(config_data[f'{col}_range'], config_data[f'ohe_{col}_path'])
 
-    train_set_rus = rus_fit_resample(train_set)
-    train_set_ros = ros_fit_resample(train_set)
-    train_set_sm = sm_fit_resample(train_set)
+    for col in ['Department', 'JobRole', 'OverTime']:
+        train_set = ohe_transform(train_set, col, config_data[f"ohe_{col}_path"], ohe = ohe_encoders[col])
+        valid_set = ohe_transform(valid_set, col, config_data[f"ohe_{col}_path"], ohe = ohe_encoders[col])
+        test_set = ohe_transform(test_set, col, config_data[f"ohe_{col}_path"], ohe = ohe_encoders[col])
 
     le_encoder = le_fit(config_data["Attrition_range"], config_data["le_encoder_path"])
 
-    train_set['Attrition'] = le_transform(train_set['Attrition'], config_data)
+    train_set['Attrition'] = le_transform(train_set['Attrition'], config_data, le_encoder = le_encoder)
+    valid_set['Attrition'] = le_transform(valid_set['Attrition'], config_data, le_encoder = le_encoder)
+    test_set['Attrition'] = le_transform(test_set['Attrition'], config_data, le_encoder = le_encoder)
 
-    train_set_rus['Attrition'] = le_transform(train_set_rus['Attrition'], config_data)
-    train_set_ros['Attrition'] = le_transform(train_set_ros['Attrition'], config_data)
-    train_set_sm['Attrition'] = le_transform(train_set_sm['Attrition'], config_data)
-    valid_set['Attrition'] = le_transform(valid_set['Attrition'], config_data)
-    test_set['Attrition'] = le_transform(test_set['Attrition'], config_data)
+    x_train = train_set.drop(columns = "Attrition")
+    y_train = train_set.Attrition
 
-    train_set.Attrition.value_counts()
-
-    x_train = {
-        "No sampling" : train_set.drop(columns = "Attrition"),
-        "Undersampling" : train_set_rus.drop(columns = "Attrition"),
-        "Oversampling" : train_set_ros.drop(columns = "Attrition"),
-        "SMOTE" : train_set_sm.drop(columns = "Attrition")
+    # Resampled sets are kept as plans over rows of the training set, never as copies
+    plans = {
+        "No sampling" : None,
+        "Undersampling" : rus_plan(y_train.to_numpy()),
+        "Oversampling" : ros_plan(y_train.to_numpy()),
+        "SMOTE" : smote_plan(x_train.to_numpy(dtype = np.float64), y_train.to_numpy(), config_data)
     }
+    resampling_dump(plans, config_data)
 
-    y_train = {
-        "No sampling" : train_set.Attrition,
-        "Undersampling" : train_set_rus.Attrition,
-        "Oversampling" : train_set_ros.Attrition,
-        "SMOTE" : train_set_sm.Attrition
-    }
+    util.dataset_dump(x_train, config_data['train_set_feng_path']['x'])
+    util.dataset_dump(y_train, config_data['train_set_feng_path']['y'])
 
-    util.pickle_dump(x_train, config_data['train_set_feng_path']['x'])
-    util.pickle_dump(y_train, config_data['train_set_feng_path']['y'])
+    util.dataset_dump(valid_set.drop(columns = "Attrition"), config_data['valid_set_feng_path']['x'])
+    util.dataset_dump(valid_set.Attrition, config_data['valid_set_feng_path']['y'])
 
-    util.pickle_dump(valid_set.drop(columns = "Attrition"), config_data['valid_set_feng_path']['x'])
-    util.pickle_dump(valid_set.Attrition, config_data['valid_set_feng_path']['y'])
+    util.dataset_dump(test_set.drop(columns = "Attrition"), config_data['test_set_feng_path']['x'])
+    util.dataset_dump(test_set.Attrition, config_data['test_set_feng_path']['y'])
 
-    util.pickle_dump(test_set.drop(columns = "Attrition"), config_data['test_set_feng_path']['x'])
-    util.pickle_dump(test_set.Attrition, config_data['test_set_feng_path']['y'])
\ No newline at end of file
+    feng_array_dump(
+        x_train, y_train,
+        valid_set.drop(columns = "Attrition"), valid_set.Attrition,
+        test_set.drop(columns = "Attrition"), test_set.Attrition,
+        config_data
+    )
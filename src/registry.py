@@ -0,0 +1,68 @@
+import os
+import re
+
+import util as util
+
+# Model UIDs are md5 hex digests, anything else never names a registry file
+uid_pattern = re.compile(r"[0-9a-f]{32}")
+
+def version_path(model_uid: str, params: dict) -> str:
+    if not isinstance(model_uid, str) or uid_pattern.fullmatch(model_uid) is None:
+        raise RuntimeError("Invalid model UID {!r}.".format(model_uid))
+    return os.path.join(params["model_registry_path"], f"{model_uid}.pkl")
+
+def pinned_path(params: dict) -> str:
+    return os.path.join(params["model_registry_path"], "pinned")
+
+def register_model(production_model: dict, params: dict, before_replace = None) -> str:
+    # Store production model under its UID, existing version is kept as is
+    model_uid = production_model["model_data"]["model_uid"]
+    os.makedirs(params["model_registry_path"], exist_ok = True)
+
+    if not os.path.exists(version_path(model_uid, params)):
+        util.pickle_dump(production_model, version_path(model_uid, params), before_replace)
+        util.print_debug("Model {} registered.".format(model_uid))
+
+    return model_uid
+
+def list_versions(params: dict) -> list:
+    # Registered UIDs, oldest first
+    try:
+        file_names = [file_name for file_name in os.listdir(params["model_registry_path"]) if file_name.endswith(".pkl")]
+    except FileNotFoundError:
+        return []
+
+    file_names.sort(key = lambda file_name: os.path.getmtime(os.path.join(params["model_registry_path"], file_name)))
+    return [file_name[:-len(".pkl")] for file_name in file_names]
+
+def pinned_version(params: dict) -> str:
+    # Return pinned UID, None when serving follows production model
+    try:
+        with open(pinned_path(params), "r") as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def pin_version(model_uid: str, params: dict) -> None:
+    # Only registered versions can be pinned, UID is never used as a path before that
+    if model_uid not in list_versions(params):
+        raise RuntimeError("Model {} not found in registry.".format(model_uid))
+
+    # Write then rename so watcher never reads partial UID
+    tmp_path = f"{pinned_path(params)}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(model_uid)
+    os.replace(tmp_path, pinned_path(params))
+
+def unpin_version(params: dict) -> None:
+    try:
+        os.remove(pinned_path(params))
+    except FileNotFoundError:
+        pass
+
+def resolve_model_path(params: dict) -> str:
+    # Pinned version wins over current production model
+    model_uid = pinned_version(params)
+    if model_uid is not None:
+        return version_path(model_uid, params)
+    return params["production_model_path"]
@@ -0,0 +1,221 @@
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import util as util
+import data_pipeline as data_pipeline
+import inference as inference
+
+def read_chunks(input_path: str, chunk_size: int, columns: list):
+    # Stream input file in fixed size chunks, only reading required columns
+    if input_path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(input_path)
+        columns = [col for col in columns if col in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size = chunk_size, columns = columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(input_path, chunksize = chunk_size, usecols = lambda col: col in columns)
+
+class ChunkWriter:
+    """
+    Append scored chunks to CSV or Parquet output without holding previous chunks.
+    """
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        self.parquet_writer = None
+        self.header = True
+
+    def write(self, chunk: pd.DataFrame) -> None:
+        if self.output_path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk, preserve_index = False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.output_path, table.schema)
+            self.parquet_writer.write_table(table.cast(self.parquet_writer.schema))
+        else:
+            chunk.to_csv(self.output_path, mode = "w" if self.header else "a", header = self.header, index = False)
+            self.header = False
+
+    def close(self) -> None:
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+def row_hashes(chunk: pd.DataFrame, columns: list) -> np.ndarray:
+    # Hash of predictor values per row, equal values give equal hash in every snapshot
+    hashes = pd.util.hash_pandas_object(chunk.reindex(columns = columns), index = False).to_numpy()
+    return np.char.mod("%016x", hashes).astype(object)
+
+def file_columns(input_path: str) -> list:
+    # Column names from file header or schema, no rows are read
+    if input_path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(input_path).schema_arrow.names
+    return pd.read_csv(input_path, nrows = 0).columns.to_list()
+
+def load_previous(previous_path: str, id_columns: list, top_k: int, chunk_size: int, model_uid: str) -> pd.DataFrame:
+    """
+    Reusable rows of previous scored output indexed by identifier columns. Output is streamed
+    in chunks and only rows scored without error by the serving model are kept, so memory
+    is bounded by the rows that can be reused.
+    """
+    columns = id_columns + ["probability", "error_msg", "model_uid", "row_hash"] + \
+        [f"factor_{i + 1}{suffix}" for i in range(top_k) for suffix in ["", "_shap"]]
+
+    # Checked on header, before any row is read
+    previous_columns = set(file_columns(previous_path))
+    missing_ids = [col for col in id_columns if col not in previous_columns]
+    if len(missing_ids) > 0:
+        raise RuntimeError("Previous output has no identifier columns {}, it was scored without the same --id-columns.".format(missing_ids))
+    missing_columns = [col for col in columns if col not in previous_columns]
+    if len(missing_columns) > 0:
+        raise RuntimeError("Previous output misses columns {}, score it again with the same options.".format(missing_columns))
+
+    # Written empty strings come back as missing values from CSV
+    text_columns = ["error_msg", "model_uid", "row_hash"] + [f"factor_{i + 1}" for i in range(top_k)]
+    reusable = list()
+    for chunk in read_chunks(previous_path, chunk_size, columns):
+        chunk[text_columns] = chunk[text_columns].fillna("")
+        chunk = chunk[(chunk["model_uid"] == model_uid) & (chunk["error_msg"] == "")]
+        reusable.append(chunk.drop(columns = ["error_msg", "model_uid"]))
+
+    previous = pd.concat(reusable) if len(reusable) > 0 else pd.DataFrame(columns = [col for col in columns if col not in ["error_msg", "model_uid"]])
+    return previous.drop_duplicates(subset = id_columns, keep = "last").set_index(id_columns)
+
+def split_unchanged(chunk: pd.DataFrame, previous: pd.DataFrame, config_data: dict, id_columns: list, model_uid: str) -> tuple:
+    # Previous result of every row by identifier, missing for new employees
+    matched = previous.reindex(pd.MultiIndex.from_frame(chunk[id_columns]) if len(id_columns) > 1 else chunk[id_columns[0]])
+    hashes = row_hashes(chunk, config_data["predictor_columns"])
+
+    # Previous rows are all from same model without error, reuse those with same features
+    unchanged = matched["row_hash"].to_numpy() == hashes
+
+    reused = matched[unchanged].set_index(chunk.index[unchanged])
+    reused["error_msg"] = ""
+    reused["model_uid"] = model_uid
+    reused = pd.concat([chunk.loc[unchanged, id_columns], reused], axis = 1)
+    return reused, chunk[~unchanged]
+
+def merge_scored(reused: pd.DataFrame, scored: pd.DataFrame, index: pd.Index) -> pd.DataFrame:
+    # Back in input order, with columns as written by score_chunk
+    if reused is None or len(reused) == 0:
+        return scored
+    return pd.concat([scored, reused[scored.columns]]).loc[index]
+
+def score_chunk(chunk: pd.DataFrame, config_data: dict, validator: data_pipeline.SchemaValidator,
+                id_columns: list = [], top_k: int = 0, approximate: bool = True) -> pd.DataFrame:
+    context = inference.get_context(config_data)
+
+    # Output keeps identifier columns next to the score
+    res = chunk[id_columns].copy()
+    res["probability"] = np.nan
+
+    # check data, invalid rows are kept with their error message
+    res["error_msg"] = validator.error_messages(chunk)
+    valid_rows = res.index[res["error_msg"] == ""]
+
+    for i in range(top_k):
+        res[f"factor_{i + 1}"] = ""
+        res[f"factor_{i + 1}_shap"] = np.nan
+
+    # Model and features the score belongs to, used by delta scoring of next snapshot
+    res["model_uid"] = context.model_uid
+    res["row_hash"] = row_hashes(chunk, config_data["predictor_columns"])
+
+    if len(valid_rows) == 0:
+        return res
+
+    # encoding and predict
+    data = context.encode(chunk.loc[valid_rows])
+    res.loc[valid_rows, "probability"] = context.predict_proba(data)
+
+    # Strongest contributors toward turnover (last class)
+    if top_k > 0:
+        shap_values = context.explain(data, approximate)["shap_values"]
+        if shap_values.ndim == 3:
+            shap_values = shap_values[:, :, -1]
+        top = np.argsort(-np.abs(shap_values), axis = 1, kind = "stable")[:, :top_k]
+        feature_names = np.asarray(context.feature_encoder.feature_names, dtype = object)
+        for i in range(top.shape[1]):
+            res.loc[valid_rows, f"factor_{i + 1}"] = feature_names[top[:, i]]
+            res.loc[valid_rows, f"factor_{i + 1}_shap"] = np.take_along_axis(shap_values, top[:, i:i+1], axis = 1)[:, 0]
+
+    return res
+
+def score_file(input_path: str, output_path: str, config_data: dict, chunk_size: int = 100000, id_columns: list = [],
+               top_k: int = 0, approximate: bool = True, workers: int = 1, previous_path: str = None) -> int:
+    columns = config_data["predictor_columns"] + id_columns
+    chunks = read_chunks(input_path, chunk_size, columns)
+    writer = ChunkWriter(output_path)
+    validator = data_pipeline.SchemaValidator(config_data)
+    n_rows = 0
+    n_reused = 0
+
+    # Delta mode: unchanged rows take their result from previous output of the same model
+    previous = None
+    if previous_path is not None:
+        model_uid = inference.get_context(config_data).model_uid
+        previous = load_previous(previous_path, id_columns, top_k, chunk_size, model_uid)
+
+    def split(chunk):
+        if previous is None:
+            return None, chunk
+        return split_unchanged(chunk, previous, config_data, id_columns, model_uid)
+
+    def write(reused, scored, index):
+        nonlocal n_rows, n_reused
+        res = merge_scored(reused, scored, index)
+        writer.write(res)
+        n_rows += len(res)
+        n_reused += 0 if reused is None else len(reused)
+        util.print_debug("{} rows scored, {} reused from previous output.".format(n_rows, n_reused))
+
+    try:
+        if workers <= 1:
+            for chunk in chunks:
+                reused, changed = split(chunk)
+                scored = score_chunk(changed, config_data, validator, id_columns, top_k, approximate)
+                write(reused, scored, chunk.index)
+        else:
+            # Bounded number of chunks in flight keeps memory flat, output keeps input order
+            with ProcessPoolExecutor(max_workers = workers) as executor:
+                in_flight = deque()
+                for chunk in chunks:
+                    reused, changed = split(chunk)
+                    future = executor.submit(score_chunk, changed, config_data, validator, id_columns, top_k, approximate)
+                    in_flight.append((reused, future, chunk.index))
+                    if len(in_flight) >= 2 * workers:
+                        reused, future, index = in_flight.popleft()
+                        write(reused, future.result(), index)
+
+                while len(in_flight) > 0:
+                    reused, future, index = in_flight.popleft()
+                    write(reused, future.result(), index)
+    finally:
+        writer.close()
+
+    return n_rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Score employee turnover probability of a CSV or Parquet file")
+    parser.add_argument("input_path")
+    parser.add_argument("output_path")
+    parser.add_argument("--chunk-size", type = int, default = 100000)
+    parser.add_argument("--id-columns", nargs = "*", default = [], help = "Columns copied to output, e.g. EmployeeNumber")
+    parser.add_argument("--top-k", type = int, default = 0, help = "Number of SHAP factors written per row")
+    parser.add_argument("--exact", action = "store_true", help = "Exact SHAP values instead of approximate")
+    parser.add_argument("--workers", type = int, default = 1)
+    parser.add_argument("--previous", help = "Scored output of previous snapshot, only changed rows are scored again")
+    args = parser.parse_args()
+
+    if args.previous is not None and len(args.id_columns) == 0:
+        parser.error("--previous requires --id-columns to match employees between snapshots")
+
+    config_data = util.load_config()
+    n_rows = score_file(args.input_path, args.output_path, config_data, args.chunk_size, args.id_columns,
+                        args.top_k, not args.exact, args.workers, args.previous)
+    util.print_debug("Scoring finished, {} rows written to {}.".format(n_rows, args.output_path))
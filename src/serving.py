@@ -0,0 +1,261 @@
+import asyncio
+import functools
+import gc
+import hashlib
+import json
+import os
+import signal
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from starlette.concurrency import run_in_threadpool
+
+import util as util
+
+class PoolFullError(RuntimeError):
+    pass
+
+class InferencePool:
+    """
+    Bounded worker pool for CPU bound inference. At most `workers` jobs run at once and
+    `queue_depth` more may wait, anything beyond that is rejected so caller can answer 429.
+    """
+    def __init__(self, workers: int, queue_depth: int, enabled: bool = True):
+        self.enabled = enabled
+        self.capacity = workers + queue_depth
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "inference") if enabled else None
+
+    async def run(self, func, *args, **kwargs):
+        # Disabled pool behaves like plain sync handler on starlette's threadpool
+        if not self.enabled:
+            return await run_in_threadpool(func, *args, **kwargs)
+
+        # Counter is only touched from event loop thread, no lock required
+        if self.pending >= self.capacity:
+            raise PoolFullError("Inference queue is full.")
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait = False)
+
+class PredictionBatcher:
+    """
+    Coalesce concurrent single record requests. Records arriving within `max_wait_ms` of
+    the first one, up to `max_batch_size`, are scored by one call of `func` on the pool,
+    which must return one result per record in the same order.
+    """
+    def __init__(self, pool: InferencePool, func, max_batch_size: int, max_wait_ms: float):
+        self.pool = pool
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.loop = None
+        self.queue = None
+        self.collector = None
+        self.tasks = set()
+
+    async def submit(self, item):
+        # Start collector on first use, inside the serving event loop
+        if self.loop is not asyncio.get_running_loop() or self.collector.done():
+            self.loop = asyncio.get_running_loop()
+            self.queue = asyncio.Queue()
+            self.collector = asyncio.create_task(self.collect())
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for first record, then gather more until batch is full or wait is over
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Score batch in background so next batch can be collected meanwhile
+            task = asyncio.create_task(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch: list) -> None:
+        try:
+            results = await self.pool.run(self.func, [item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # Fan results back out to callers, a caller left without result gets an error instead of waiting
+        if len(results) != len(batch):
+            util.print_debug("Batch of {} requests returned {} results.".format(len(batch), len(results)))
+        for i, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if i < len(results):
+                future.set_result(results[i])
+            else:
+                future.set_exception(RuntimeError("No result returned for request {} of batch of {}.".format(i, len(batch))))
+
+class PredictionCache:
+    """
+    LRU cache with TTL for prediction responses. Keys carry the model UID, and the whole
+    cache is dropped as soon as a different model UID is seen, so swapped models never
+    serve stale results. Size is capped by entries and by approximate payload bytes.
+    """
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.model_uid = None
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(record: dict, *options) -> str:
+        # Canonical form: sorted keys, no whitespace
+        canonical = json.dumps([record, options], sort_keys = True, separators = (",", ":"))
+        return hashlib.sha1(canonical.encode()).hexdigest()
+
+    def check_model(self, model_uid: str) -> None:
+        # Caller holds the lock
+        if model_uid != self.model_uid:
+            if len(self.entries) > 0:
+                self.invalidations += 1
+            self.entries.clear()
+            self.size_bytes = 0
+            self.model_uid = model_uid
+
+    def get(self, key: str, model_uid: str):
+        with self.lock:
+            self.check_model(model_uid)
+            entry = self.entries.get(key)
+
+            # Expired entry counts as miss
+            if entry is not None and time.monotonic() - entry[2] > self.ttl_seconds:
+                self.remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, model_uid: str, value: dict) -> None:
+        # Approximate payload size, numpy scalars are sized as floats
+        size = len(json.dumps(value, default = float))
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            # Result of a model that is no longer served
+            if model_uid != self.model_uid:
+                return
+
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, size, time.monotonic())
+            self.size_bytes += size
+
+            # Evict least recently used
+            while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key: str) -> None:
+        _, size, _ = self.entries.pop(key)
+        self.size_bytes -= size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"model_uid" : self.model_uid,
+                    "entries" : len(self.entries),
+                    "size_bytes" : self.size_bytes,
+                    "max_entries" : self.max_entries,
+                    "max_bytes" : self.max_bytes,
+                    "hits" : self.hits,
+                    "misses" : self.misses,
+                    "evictions" : self.evictions,
+                    "invalidations" : self.invalidations}
+
+def serve_prefork(app, host: str, port: int, workers: int, preload) -> None:
+    """
+    Pre-fork serving: `preload` loads inference objects once in this process, then `workers`
+    forked processes serve `app` on one shared listening socket. Pages loaded before fork are
+    shared copy-on-write, workers only pay for what they touch. A worker that dies is replaced.
+    """
+    import uvicorn
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+
+    preload()
+
+    # Collector never scans preloaded objects, scanning would write to them and unshare their pages
+    gc.collect()
+    gc.freeze()
+
+    def spawn() -> int:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            uvicorn.Server(uvicorn.Config(app, host = host, port = port)).run(sockets = [sock])
+            os._exit(0)
+        return pid
+
+    stopping = False
+    children = set()
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for _ in range(workers):
+        children.add(spawn())
+    util.print_debug("Serving on {}:{} with {} preforked workers.".format(host, port, workers))
+
+    while len(children) > 0:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            util.print_debug("Worker {} exited, starting a new one.".format(pid))
+            children.add(spawn())
+
+    sock.close()
@@ -1,17 +1,49 @@
+import io
 import streamlit as st
 import requests
 from PIL import Image
 import util as util
-import time
-
-import shap as shap
-import streamlit_shap as st_shap
 
 import numpy as np
 import pandas as pd
 
 config_data = util.load_config()
 
+@st.cache_resource
+def http_session() -> requests.Session:
+    # One pooled session per server process, connections are reused across reruns
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = 10)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def post(path: str, payload: dict) -> dict:
+    res = http_session().post(config_data["streamlit_api_url"] + path, json = payload, timeout = config_data["streamlit_api_timeout"])
+    res.raise_for_status()
+    return res.json()
+
+# Same submission is answered from cache, failed requests raise and are not cached
+@st.cache_data(ttl = config_data["streamlit_cache_ttl_seconds"], show_spinner = False)
+def predict(raw_data: dict) -> dict:
+    return post("/predict/", raw_data)
+
+@st.cache_data(ttl = config_data["streamlit_cache_ttl_seconds"], show_spinner = False)
+def predict_csv(csv_data: bytes) -> pd.DataFrame:
+    # Whole file scored by one batched call, as columns of predictors
+    data = pd.read_csv(io.BytesIO(csv_data))
+    missing_columns = [col for col in config_data["predictor_columns"] if col not in data.columns]
+    if len(missing_columns) > 0:
+        raise ValueError("Columns {} are missing in CSV file.".format(missing_columns))
+
+    predictors = data[config_data["predictor_columns"]].astype(object)
+    predictors = predictors.where(predictors.notna(), None)
+    res = post("/predict/batch", {"columns": {col: predictors[col].to_list() for col in predictors.columns}})
+
+    data["probability"] = res["res"]
+    data["error_msg"] = res["error_msg"]
+    return data
+
 job_levels_mapping = {
     1: "Level I - Entry",
     2: "Level II - Intermediate",
@@ -115,6 +147,14 @@ with st.sidebar:
 
         submitted = st.form_submit_button("Predict!")
 
+    with st.form(key = "emp_batch"):
+        st.subheader('Multiple employees')
+        csv_file = st.file_uploader(
+            label="CSV file with one employee per row",
+            type="csv"
+        )
+        batch_submitted = st.form_submit_button("Predict all!")
+
 if submitted:
     st.sidebar.write("Employee information has been submitted")
 
@@ -135,8 +175,10 @@ if submitted:
     }
 
     with st.spinner("Sending data to prediction server ..."):
-        time.sleep(1)
-        res = requests.post("http://0.0.0.0:8080/predict", json = raw_data).json()
+        try:
+            res = predict(raw_data)
+        except requests.RequestException as e:
+            res = {"error_msg": "prediction server is not reachable ({})".format(e)}
     
     st.header('Result', divider='rainbow')
     if res["error_msg"] != "":
@@ -150,6 +192,8 @@ if submitted:
         feature = np.array(res["shap_feature"])
         feature_names = res["shap_feature_name"]
 
+        # shap is only needed to draw the plot, not to render the form
+        import shap as shap
         p = shap.force_plot(base_value, shap_values, feature, feature_names)
 
         def st_shap(plot, height=None):
@@ -175,7 +219,22 @@ if submitted:
         for i in range(len(negative_factors)): 
             st.write(f"{i+1}. {negative_factors['feature_name'][i]} = {negative_factors['feature_value'][i]} ({negative_factors['shap_value'][i]:.0%})")
 
-
-
-        
-        
\ No newline at end of file
+if batch_submitted and csv_file is not None:
+    with st.spinner("Sending data to prediction server ..."):
+        try:
+            scored = predict_csv(csv_file.getvalue())
+        except (requests.RequestException, ValueError) as e:
+            scored = None
+            st.error("Error Occurs While Predicting: {}".format(e))
+
+    if scored is not None:
+        st.header('Result', divider='rainbow')
+        n_errors = (scored["error_msg"] != "").sum()
+        st.write(f'{len(scored) - n_errors} of {len(scored)} employees scored.')
+        st.dataframe(scored.sort_values(by='probability', ascending=False), hide_index=True)
+        st.download_button(
+            label="Download result",
+            data=scored.to_csv(index=False),
+            file_name="turnover_probability.csv",
+            mime="text/csv"
+        )
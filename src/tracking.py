@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import sqlite3
+
+import util as util
+
+# Columns queried often are stored next to the full entry and indexed
+schema = """
+CREATE TABLE IF NOT EXISTS training_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model_uid TEXT,
+    model_name TEXT,
+    training_date TEXT,
+    data_configurations TEXT,
+    f1_score_avg REAL,
+    training_time REAL,
+    entry TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS training_log_model_uid ON training_log (model_uid);
+CREATE INDEX IF NOT EXISTS training_log_model_name ON training_log (model_name);
+CREATE INDEX IF NOT EXISTS training_log_training_date ON training_log (training_date);
+CREATE TABLE IF NOT EXISTS migration (source TEXT PRIMARY KEY, n_entries INTEGER, date TEXT);
+"""
+
+def connect(params: dict) -> sqlite3.Connection:
+    """
+    Open training log database, creating it when missing. Entries of the JSON training log
+    written before are copied in once.
+    """
+    os.makedirs(os.path.dirname(params["training_log_db_path"]) or ".", exist_ok = True)
+
+    # WAL lets readers run while one writer appends, writers wait for each other
+    connection = sqlite3.connect(params["training_log_db_path"], timeout = 30, isolation_level = None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.executescript(schema)
+    migrate_json(connection, params.get("training_log_path"))
+    return connection
+
+def insert(connection: sqlite3.Connection, entry: dict) -> None:
+    # Caller holds the transaction
+    connection.execute(
+        "INSERT INTO training_log (model_uid, model_name, training_date, data_configurations, f1_score_avg, training_time, entry) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (entry.get("model_uid"), entry.get("model_name"), str(entry.get("training_date")), entry.get("data_configurations"),
+         entry.get("f1_score_avg"), entry.get("training_time"), json.dumps(entry, default = str))
+    )
+
+def migrate_json(connection: sqlite3.Connection, json_path: str) -> int:
+    # One time copy of JSON training log, recorded so it is never copied twice
+    if json_path is None or not os.path.exists(json_path):
+        return 0
+    if connection.execute("SELECT 1 FROM migration WHERE source = ?", (json_path,)).fetchone() is not None:
+        return 0
+
+    # Checked again under write lock, another process may be migrating right now
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        if connection.execute("SELECT 1 FROM migration WHERE source = ?", (json_path,)).fetchone() is not None:
+            connection.execute("COMMIT")
+            return 0
+
+        with open(json_path, "r") as file:
+            entries = json.load(file)
+        for entry in entries:
+            insert(connection, entry)
+        connection.execute("INSERT INTO migration VALUES (?, ?, ?)", (json_path, len(entries), str(util.time_stamp())))
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+    util.print_debug("Migrated {} entries of {} into training log database.".format(len(entries), json_path))
+    return len(entries)
+
+def append(entry: dict, params: dict) -> None:
+    # Single insert in its own transaction, either the whole entry is stored or nothing
+    connection = connect(params)
+    try:
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            insert(connection, entry)
+    finally:
+        connection.close()
+
+def query(params: dict, model_uid: str = None, model_name: str = None, since: str = None,
+          order_by: str = "id", limit: int = None) -> list:
+    # Entries matching every given filter, model_name may use SQL LIKE wildcards
+    conditions, values = list(), list()
+    for column, operator, value in [("model_uid", "=", model_uid), ("model_name", "LIKE", model_name), ("training_date", ">=", since)]:
+        if value is not None:
+            conditions.append(f"{column} {operator} ?")
+            values.append(value)
+
+    sql = "SELECT entry FROM training_log"
+    if len(conditions) > 0:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += {"id": " ORDER BY id", "f1": " ORDER BY f1_score_avg DESC, training_time ASC", "latest": " ORDER BY id DESC"}[order_by]
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+
+    connection = connect(params)
+    try:
+        return [json.loads(row["entry"]) for row in connection.execute(sql, values)]
+    finally:
+        connection.close()
+
+def best(params: dict, model_name: str = None) -> dict:
+    # Entry with greatest f1 score macro avg, fastest training wins ties, None when log is empty
+    entries = query(params, model_name = model_name, order_by = "f1", limit = 1)
+    return entries[0] if len(entries) > 0 else None
+
+def latest(params: dict, model_name: str = None) -> dict:
+    entries = query(params, model_name = model_name, order_by = "latest", limit = 1)
+    return entries[0] if len(entries) > 0 else None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Query training log")
+    parser.add_argument("command", choices = ["list", "best", "latest"])
+    parser.add_argument("--model-uid")
+    parser.add_argument("--model-name", help = "Model name, SQL LIKE wildcards allowed, e.g. Production-%%")
+    parser.add_argument("--since", help = "Training date lower bound, e.g. 2024-01-01")
+    parser.add_argument("--limit", type = int)
+    args = parser.parse_args()
+
+    params = util.load_config()
+    if args.command == "list":
+        entries = query(params, args.model_uid, args.model_name, args.since, limit = args.limit)
+    else:
+        entry = {"best": best, "latest": latest}[args.command](params, args.model_name)
+        entries = [] if entry is None else [entry]
+
+    for entry in entries:
+        print(f"{entry['training_date']:<28} {entry['model_uid']:<34} {entry['model_name']:<45} "
+              f"{entry.get('data_configurations') or '':<15} {entry['f1_score_avg']:.4f}")
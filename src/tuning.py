@@ -0,0 +1,100 @@
+import math
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.model_selection import RandomizedSearchCV
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingRandomSearchCV
+
+import util as util
+
+def n_rungs(n_candidates: int, factor: int) -> int:
+    # Iterations successive halving needs to narrow candidates down to one
+    return 1 + int(math.floor(math.log(max(n_candidates - 1, 1), factor)))
+
+def candidate_cost(method: str, n_candidates: int, factor: int) -> float:
+    # Work of search in full fits per fold: halving fits every rung with 1 / factor of candidates
+    # on factor times the resource, so each rung costs about the same
+    if method == "halving":
+        rungs = n_rungs(n_candidates, factor)
+        return rungs * n_candidates / factor ** (rungs - 1)
+    return n_candidates
+
+def plan_candidates(method: str, params: dict, fit_time: float) -> int:
+    """
+    Largest number of candidates, up to tuning_n_candidates, whose estimated time fits
+    tuning_budget_seconds. Estimate is based on fit time of the untuned model.
+    """
+    budget = params.get("tuning_budget_seconds")
+    n_candidates = params["tuning_n_candidates"]
+    if not budget or not fit_time:
+        return n_candidates
+
+    while n_candidates > 2 and candidate_cost(method, n_candidates, params["tuning_factor"]) * params["tuning_cv"] * fit_time > budget:
+        n_candidates -= 1
+    return n_candidates
+
+def create_tuner(model_object, dist_params: dict, params: dict, fit_time: float = None):
+    """
+    Search object over dist_params for method tuning_method of config, fitted like any
+    estimator. Tuned model is tuned again from its best estimator, not wrapped twice.
+    """
+    model_object = clone(getattr(model_object, "best_estimator_", model_object))
+    dist_params = dict(dist_params)
+    method = params["tuning_method"]
+
+    # Fit time of untuned model scales with number of trees it was fitted with
+    if fit_time is not None and "n_estimators" in dist_params:
+        fit_time = fit_time * max(dist_params["n_estimators"]) / (model_object.get_params().get("n_estimators") or 100)
+
+    # XGBoost finds its number of trees itself, on validation set passed by fit_params
+    if model_object.__class__.__name__ == "XGBClassifier" and params.get("xgb_early_stopping_rounds"):
+        model_object.set_params(n_estimators = max(dist_params.pop("n_estimators", [model_object.n_estimators or 100])),
+                                early_stopping_rounds = params["xgb_early_stopping_rounds"])
+
+    n_candidates = plan_candidates(method, params, fit_time)
+    util.print_debug("Tuning {} with {} search over {} candidates.".format(model_object.__class__.__name__, method, n_candidates))
+
+    if method == "random":
+        return RandomizedSearchCV(model_object, dist_params, n_iter = n_candidates, cv = params["tuning_cv"], n_jobs = -1)
+
+    if method == "halving":
+        # Ensembles grow trees as resource, anything else grows training samples
+        resource = "n_samples"
+        max_resources = "auto"
+        if "n_estimators" in dist_params:
+            resource = "n_estimators"
+            max_resources = max(dist_params.pop("n_estimators"))
+
+        return HalvingRandomSearchCV(model_object, dist_params, n_candidates = n_candidates, factor = params["tuning_factor"],
+                                     resource = resource, max_resources = max_resources, min_resources = "exhaust",
+                                     cv = params["tuning_cv"], n_jobs = -1)
+
+    raise RuntimeError("Unknown tuning method {}.".format(method))
+
+def fit_params(model_object, x_valid, y_valid) -> dict:
+    # Validation set for early stopping of XGBoost, plain or inside search
+    estimator = getattr(model_object, "estimator", model_object)
+    if estimator.get_params().get("early_stopping_rounds"):
+        return {"eval_set": [(x_valid, y_valid)], "verbose": False}
+    return {}
+
+def candidate_log(model_object) -> list:
+    # Params, resource, score and time spent on every fitted candidate, None for untuned model
+    if not hasattr(model_object, "cv_results_"):
+        return None
+
+    results = model_object.cv_results_
+    n_candidates = len(results["params"])
+    iterations = results.get("iter", np.zeros(n_candidates, dtype = int))
+    resources = results.get("n_resources", np.full(n_candidates, -1))
+
+    log = list()
+    for i, candidate in enumerate(results["params"]):
+        score = float(results["mean_test_score"][i])
+        log.append({"params": {name: value.item() if hasattr(value, "item") else value for name, value in candidate.items()},
+                    "iteration": int(iterations[i]),
+                    "n_resources": int(resources[i]),
+                    "time": float((results["mean_fit_time"][i] + results["mean_score_time"][i]) * model_object.n_splits_),
+                    "score": None if np.isnan(score) else score})
+    return log
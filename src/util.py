@@ -1,18 +1,24 @@
-import yaml
-import joblib
+import json
+import os
+import resource
+import numpy as np
+import pandas as pd
 from datetime import datetime
 
-config_dir = "config/config.yaml"
+# Config is found from any working directory, relative to repository root
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+config_dir = os.environ.get("CONFIG_PATH", os.path.join(repo_dir, "config", "config.yaml"))
 
 def time_stamp() -> datetime:
     # Return current date and time
     return datetime.now()
 
-def load_config() -> dict: 
-    # Try to load yaml file
+def load_config() -> dict:
+    # Load yaml config, with the C parser when available
+    import yaml
     try:
         with open(config_dir, "r") as file:
-            config = yaml.safe_load(file)
+            config = yaml.load(file, Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader))
     except FileNotFoundError as fe:
         raise RuntimeError("Parameters file not found in path.")
 
@@ -20,12 +26,155 @@ def load_config() -> dict:
     return config
 
 def pickle_load(file_path: str):
-    # Load and return pickle file
+    # Load and return pickle file, joblib is imported only by processes that need it
+    import joblib
     return joblib.load(file_path)
 
-def pickle_dump(data, file_path: str) -> None:
-    # Dump data into file
-    joblib.dump(data, file_path)
+def pickle_dump(data, file_path: str, before_replace = None) -> None:
+    # Dump data into temporary file then rename, so readers never see half written file.
+    # before_replace gets the temporary path, for files that must be in place before this one
+    import joblib
+    tmp_path = f"{file_path}.tmp"
+    joblib.dump(data, tmp_path)
+    if before_replace is not None:
+        before_replace(tmp_path)
+    os.replace(tmp_path, file_path)
+
+def dataset_dump(data, file_path: str, compression: str = "lz4") -> None:
+    """
+    Dump dataframe or series as compressed Arrow IPC (Feather) file, which keeps schema and
+    index and can be read back per column.
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    # Series is stored as one column table and flagged, so it loads back as series
+    is_series = isinstance(data, pd.Series)
+    table = pa.Table.from_pandas(data.to_frame() if is_series else data)
+    metadata = {**table.schema.metadata, b"is_series": str(is_series).encode()}
+
+    tmp_path = f"{file_path}.tmp"
+    feather.write_feather(table.replace_schema_metadata(metadata), tmp_path, compression = compression)
+    os.replace(tmp_path, file_path)
+
+def dataset_load(file_path: str, columns: list = None):
+    """
+    Load file written by dataset_dump through memory map. Only the given columns, plus the
+    index, are read from disk.
+    """
+    import json
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    # Index columns must be read along with projected columns to restore the index
+    if columns is not None:
+        with pa.memory_map(file_path) as source:
+            schema = pa.ipc.open_file(source).schema
+        index_columns = [col for col in json.loads(schema.metadata[b"pandas"])["index_columns"] if isinstance(col, str)]
+        columns = [col for col in schema.names if col in columns or col in index_columns]
+
+    table = feather.read_table(file_path, columns = columns, memory_map = True)
+    is_series = table.schema.metadata.get(b"is_series") == b"True"
+    # Arrow buffers are released while converting, so peak memory stays near one copy
+    data = table.to_pandas(split_blocks = True, self_destruct = True)
+    if is_series:
+        return data.iloc[:, 0]
+    return data
+
+def array_dump(data, file_path: str, dtype) -> None:
+    # Dump dataframe or series as one contiguous array, written then renamed
+    tmp_path = f"{file_path}.tmp.npy"
+    np.save(tmp_path, np.ascontiguousarray(data.to_numpy(dtype = dtype)))
+    os.replace(tmp_path, file_path)
+
+class ArrayHandle:
+    """
+    Picklable reference to an array file. Whichever process loads it gets a read only
+    memory-mapped view, so parallel workers share pages instead of receiving copies.
+    With a resampling plan, rows of the plan are built from the mapped array on load.
+    """
+    def __init__(self, file_path: str, columns: list = None, name: str = None, plan_path: str = None, integer: list = None):
+        self.file_path = file_path
+        self.columns = columns
+        self.name = name
+        self.plan_path = plan_path
+        self.integer = integer
+
+    def load(self):
+        array = np.load(self.file_path, mmap_mode = "r")
+        if self.plan_path is not None:
+            integer = None if self.integer is None else np.asarray(self.integer, dtype = bool)
+            array = resample_array(array, plan_load(self.plan_path), integer)
+        if self.columns is None:
+            return pd.Series(array, name = self.name, copy = False)
+        return pd.DataFrame(array, columns = self.columns, copy = False)
+
+def plan_dump(plan: dict, file_path: str) -> None:
+    # Resampling plan as plain arrays, written then renamed
+    tmp_path = f"{file_path}.tmp.npz"
+    np.savez(tmp_path, **plan)
+    os.replace(tmp_path, file_path)
+
+def plan_load(file_path: str) -> dict:
+    with np.load(file_path, allow_pickle = False) as plan:
+        return {key: plan[key] for key in plan.files}
+
+def resampling_plans(resampling_path: str) -> dict:
+    # Plan file of every training set configuration, None for the base training set itself
+    with open(os.path.join(resampling_path, "meta.json"), "r") as file:
+        configurations = json.load(file)["configurations"]
+    return {configuration: None if file_name is None else os.path.join(resampling_path, file_name)
+            for configuration, file_name in configurations.items()}
+
+def resample_array(array: np.ndarray, plan: dict, integer: np.ndarray = None, chunk_rows: int = 100000) -> np.ndarray:
+    """
+    Rows of resampled set: base rows at plan index, followed by synthetic rows on the line
+    from origin row to neighbor row, as SMOTE builds them. 1d array is the label. Synthetic
+    values of integer columns are truncated, like casting SMOTE output back to int does.
+    """
+    index, origin, neighbor, step = plan["index"], plan["origin"], plan["neighbor"], plan["step"]
+    if array.ndim == 1:
+        return np.concatenate([array[index], plan["label"].astype(array.dtype)])
+
+    resampled = np.empty((len(index) + len(origin), array.shape[1]), dtype = array.dtype)
+    np.take(array, index, axis = 0, out = resampled[:len(index)])
+
+    # Synthetic rows in chunks, computed in float64 like SMOTE does
+    for start in range(0, len(origin), chunk_rows):
+        end = min(start + chunk_rows, len(origin))
+        base = array[origin[start:end]].astype(np.float64)
+        synthetic = base + step[start:end, None] * (array[neighbor[start:end]] - base)
+        if integer is not None:
+            synthetic[:, integer] = np.trunc(synthetic[:, integer])
+        resampled[len(index) + start:len(index) + end] = synthetic
+    return resampled
+
+def resample(data, plan: dict):
+    # Dataframe or series counterpart of resample_array, column dtypes are kept
+    if isinstance(data, pd.Series):
+        return pd.Series(resample_array(data.to_numpy(), plan), name = data.name)
+    integer = np.array([pd.api.types.is_integer_dtype(dtype) for dtype in data.dtypes])
+    resampled = resample_array(data.to_numpy(dtype = np.float64), plan, integer)
+    return pd.DataFrame(resampled, columns = data.columns).astype(data.dtypes.to_dict())
+
+def reset_peak_memory() -> None:
+    # Reset peak RSS of this process, only supported on Linux
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+def peak_memory_mb() -> float:
+    # Peak RSS since last reset, falls back to peak RSS of process lifetime
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
 params = load_config()
 PRINT_DEBUG = params["print_debug"]